@@ -0,0 +1,354 @@
+"""
+This module keeps the chat messages in an append-only log on disk, so they survive
+a restart and clients can page back through the history.
+The log is split into segment files of length-prefixed records. Writes are appended
+as they happen and synced to disk in periodic batches; reads go through memory maps
+and a sparse offset index, so only the requested page is decoded.
+"""
+
+# --------------------------------------------------------------------------------
+# Imports
+# --------------------------------------------------------------------------------
+
+import array
+import asyncio
+import bisect
+import json
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+# --------------------------------------------------------------------------------
+# Settings
+# --------------------------------------------------------------------------------
+
+# Directory of the segment files, relative to the working directory.
+CHAT_LOG_DIR: str = "data/chat"
+# A new segment is started once the current one would grow past this size.
+CHAT_LOG_SEGMENT_BYTES: int = 16 * 1024 * 1024
+# One offset is indexed every this many records.
+CHAT_LOG_INDEX_INTERVAL: int = 64
+# Seconds between two syncs of the appended records to disk.
+CHAT_LOG_FSYNC_INTERVAL: float = 1.0
+# Retention, applied when a segment rolls over and when the log is opened: the
+# oldest segments are deleted beyond this count or once older than this age.
+CHAT_LOG_RETENTION_SEGMENTS: int = 64
+CHAT_LOG_RETENTION_SECONDS: float = 30 * 24 * 3600
+# Messages per history page, the largest page a client may ask for, and the records
+# scanned at most per page when only one room's messages are wanted.
+CHAT_HISTORY_PAGE_SIZE: int = 50
+CHAT_HISTORY_PAGE_MAX: int = 200
+CHAT_HISTORY_SCAN_LIMIT: int = 10000
+
+# Record header: payload length, CRC-32 of the payload, sequence number
+RECORD_HEADER: struct.Struct = struct.Struct(">IIQ")
+SEGMENT_SUFFIX: str = ".log"
+
+ChatRecord = Tuple[int, str, str]  # (sequence number, formatted time, message)
+
+
+# --------------------------------------------------------------------------------
+# Log segment
+# --------------------------------------------------------------------------------
+class Segment:
+    def __init__(self, path: str, first_seq: int):
+        """
+        One segment file. Sequence numbers are contiguous within a segment, so the
+        sparse index is a plain array: offsets[k] is the offset of record
+        first_seq + k * interval.
+        """
+        self.path: str = path
+        self.first_seq: int = first_seq
+        self.count: int = 0
+        self.size: int = 0
+        self.offsets: Optional[array.array] = None  # Built on first read for old segments
+        self._map: Optional[mmap.mmap] = None
+
+    def view(self) -> mmap.mmap:
+        """
+        Returns a read-only memory map of the segment, remapped if the segment grew.
+        """
+        if self._map is None or len(self._map) < self.size:
+            self.close()
+            with open(self.path, "rb") as file:
+                self._map = mmap.mmap(file.fileno(), self.size, access=mmap.ACCESS_READ)
+        return self._map
+
+    def scan(self, interval: int, verify: bool) -> None:
+        """
+        Walks the record headers to build the sparse index, and stops at the first
+        record that is cut short (or, with `verify`, fails its checksum).
+        """
+        file_size: int = os.path.getsize(self.path)
+        offsets: array.array = array.array("Q")
+        offset: int = 0
+        count: int = 0
+        if file_size:
+            with open(self.path, "rb") as file, mmap.mmap(file.fileno(), file_size, access=mmap.ACCESS_READ) as data:
+                while offset + RECORD_HEADER.size <= file_size:
+                    length, crc, seq = RECORD_HEADER.unpack_from(data, offset)
+                    end: int = offset + RECORD_HEADER.size + length
+                    if end > file_size or seq != self.first_seq + count:
+                        break
+                    if verify and zlib.crc32(data[offset + RECORD_HEADER.size:end]) != crc:
+                        break
+                    if count % interval == 0:
+                        offsets.append(offset)
+                    offset = end
+                    count += 1
+        self.count, self.size, self.offsets = count, offset, offsets
+
+    def close(self) -> None:
+        """
+        Unmaps the segment.
+        """
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+# --------------------------------------------------------------------------------
+# Chat log
+# --------------------------------------------------------------------------------
+class ChatLog:
+    def __init__(
+        self,
+        directory: str = CHAT_LOG_DIR,
+        segment_bytes: int = CHAT_LOG_SEGMENT_BYTES,
+        index_interval: int = CHAT_LOG_INDEX_INTERVAL,
+        fsync_interval: float = CHAT_LOG_FSYNC_INTERVAL,
+        retention_segments: int = CHAT_LOG_RETENTION_SEGMENTS,
+        retention_seconds: float = CHAT_LOG_RETENTION_SECONDS,
+    ):
+        """
+        Append-only log of chat messages, numbered by a sequence number that keeps
+        growing across segments and restarts. The files are opened by `start`, or
+        on first use. One worker writes the log; it is only used from the event loop.
+        """
+        self.directory: str = directory
+        self.segment_bytes: int = segment_bytes
+        self.index_interval: int = index_interval
+        self.fsync_interval: float = fsync_interval
+        self.retention_segments: int = retention_segments
+        self.retention_seconds: float = retention_seconds
+        self._segments: List[Segment] = []  # Oldest first, the last one is appended to
+        self._first_seqs: List[int] = []
+        self._fd: Optional[int] = None
+        self._unsynced: int = 0
+        self._task: Optional[asyncio.Task] = None
+        self.stats: Dict[str, int] = {"appended": 0, "fsyncs": 0, "rolled": 0, "deleted": 0, "truncated_bytes": 0}
+
+    @property
+    def next_seq(self) -> int:
+        """
+        The sequence number the next message will get.
+        """
+        self._open()
+        active: Segment = self._segments[-1]
+        return active.first_seq + active.count
+
+    def _open(self) -> None:
+        """
+        Opens the log: finds the segments, recovers the last one after a crash
+        (a record cut short or corrupted ends it) and applies the retention.
+        """
+        if self._fd is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        first_seqs: List[int] = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit()
+        )
+        self._segments = [Segment(self._segment_path(first_seq), first_seq) for first_seq in first_seqs]
+        for segment, next_segment in zip(self._segments, self._segments[1:]):
+            segment.count = next_segment.first_seq - segment.first_seq
+            segment.size = os.path.getsize(segment.path)
+        if not self._segments:
+            self._segments.append(Segment(self._segment_path(0), 0))
+            open(self._segments[0].path, "ab").close()
+
+        active: Segment = self._segments[-1]
+        active.scan(self.index_interval, verify=True)
+        file_size: int = os.path.getsize(active.path)
+        if file_size > active.size:
+            # Drop the torn tail of the last write before appending after it
+            os.truncate(active.path, active.size)
+            self.stats["truncated_bytes"] += file_size - active.size
+        self._first_seqs = [segment.first_seq for segment in self._segments]
+        self._fd = os.open(active.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._apply_retention()
+
+    def _segment_path(self, first_seq: int) -> str:
+        return os.path.join(self.directory, f"{first_seq:020d}{SEGMENT_SUFFIX}")
+
+    def append(self, formatted_time: str, message: str, room: Optional[str] = None) -> int:
+        """
+        Appends a message and returns its sequence number. The record reaches the
+        page cache right away and the disk with the next periodic sync.
+        """
+        self._open()
+        payload: bytes = json.dumps([formatted_time, room, message]).encode()
+        active: Segment = self._segments[-1]
+        if active.count and active.size + RECORD_HEADER.size + len(payload) > self.segment_bytes:
+            active = self._roll()
+        seq: int = active.first_seq + active.count
+        os.write(self._fd, RECORD_HEADER.pack(len(payload), zlib.crc32(payload), seq) + payload)
+        if active.count % self.index_interval == 0:
+            active.offsets.append(active.size)
+        active.size += RECORD_HEADER.size + len(payload)
+        active.count += 1
+        self._unsynced += 1
+        self.stats["appended"] += 1
+        return seq
+
+    def _roll(self) -> Segment:
+        """
+        Seals the current segment and starts a new one.
+        """
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._unsynced = 0
+        sealed: Segment = self._segments[-1]
+        active = Segment(self._segment_path(sealed.first_seq + sealed.count), sealed.first_seq + sealed.count)
+        active.offsets = array.array("Q")
+        self._fd = os.open(active.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._segments.append(active)
+        self._first_seqs.append(active.first_seq)
+        self.stats["rolled"] += 1
+        self._apply_retention()
+        return active
+
+    def _apply_retention(self) -> None:
+        """
+        Deletes the oldest sealed segments beyond the count limit or past the age limit.
+        """
+        cutoff: float = time.time() - self.retention_seconds
+        while len(self._segments) > 1 and (
+            len(self._segments) > self.retention_segments or os.path.getmtime(self._segments[0].path) < cutoff
+        ):
+            segment: Segment = self._segments.pop(0)
+            self._first_seqs.pop(0)
+            segment.close()
+            os.remove(segment.path)
+            self.stats["deleted"] += 1
+
+    def before(
+        self,
+        before: Optional[int] = None,
+        limit: int = CHAT_HISTORY_PAGE_SIZE,
+        room: Optional[str] = None,
+        scan_limit: int = CHAT_HISTORY_SCAN_LIMIT,
+    ) -> Tuple[List[ChatRecord], Optional[int]]:
+        """
+        Returns up to `limit` messages of `room` sent before sequence number `before`
+        (the newest ones if None), oldest first, and the cursor of the next older page
+        (None once the start of the log is reached).
+        """
+        self._open()
+        records: List[ChatRecord] = []
+        cursor: Optional[int] = None
+        scanned: int = 0
+        for seq, payload in self._iter_before(self.next_seq if before is None else before):
+            if scanned == scan_limit:
+                cursor = seq + 1  # Stop scanning here, the next page carries on
+                break
+            scanned += 1
+            formatted_time, record_room, message = json.loads(payload)
+            if record_room == room:
+                records.append((seq, formatted_time, message))
+                if len(records) == limit:
+                    cursor = seq if seq > self._first_seqs[0] else None
+                    break
+        records.reverse()
+        return records, cursor
+
+    def _iter_before(self, before: int) -> Iterator[Tuple[int, bytes]]:
+        """
+        Yields the records before a sequence number, newest first. Each step decodes
+        one indexed block of records from the memory map, read forwards then reversed.
+        """
+        before = min(before, self.next_seq)
+        position: int = bisect.bisect_right(self._first_seqs, before - 1) - 1
+        for segment in reversed(self._segments[:position + 1]):
+            end: int = min(before, segment.first_seq + segment.count)
+            if end <= segment.first_seq:
+                continue
+            if segment.offsets is None:
+                segment.scan(self.index_interval, verify=False)
+            data: mmap.mmap = segment.view()
+            block: int = (end - 1 - segment.first_seq) // self.index_interval
+            while block >= 0:
+                block_seq: int = segment.first_seq + block * self.index_interval
+                offset: int = segment.offsets[block]
+                records: List[Tuple[int, bytes]] = []
+                for seq in range(block_seq, end):
+                    length, _, _ = RECORD_HEADER.unpack_from(data, offset)
+                    offset += RECORD_HEADER.size
+                    records.append((seq, data[offset:offset + length]))
+                    offset += length
+                yield from reversed(records)
+                end = block_seq
+                block -= 1
+
+    async def start(self) -> None:
+        """
+        Opens the log and starts the background task that syncs the appended records
+        to disk. Opening checks every record of the active segment, so it runs on a
+        thread, before the first request instead of on the loop during one.
+        """
+        await asyncio.to_thread(self._open)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the sync task, syncs what is left and closes the log.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.close()
+
+    async def _run(self) -> None:
+        """
+        Syncs the appended records in batches, at most once per `fsync_interval`.
+        fsync blocks, so it runs on a thread, on a duplicate of the file descriptor
+        in case the segment rolls over meanwhile.
+        """
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            if not self._unsynced or self._fd is None:
+                continue
+            self._unsynced = 0
+            fd: int = os.dup(self._fd)
+            try:
+                await asyncio.to_thread(os.fsync, fd)
+            finally:
+                os.close(fd)
+            self.stats["fsyncs"] += 1
+
+    def close(self) -> None:
+        """
+        Syncs and closes the log; it is opened again on next use.
+        """
+        if self._fd is None:
+            return
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._fd = None
+        self._unsynced = 0
+        for segment in self._segments:
+            segment.close()
+        self._segments, self._first_seqs = [], []
+
+
+# Initialize the chat log instance
+chat_log: ChatLog = ChatLog()
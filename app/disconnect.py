@@ -0,0 +1,144 @@
+"""
+This module stops the work of requests whose client has gone away.
+htmx aborts superseded requests (hx-sync) and the browser drops the requests of a
+page it leaves; without this, the server would still run those handlers to the end
+and send responses nobody reads.
+"""
+
+# --------------------------------------------------------------------------------
+# Imports
+# --------------------------------------------------------------------------------
+
+import asyncio
+import contextvars
+import threading
+from typing import Dict, Optional
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+# --------------------------------------------------------------------------------
+# Settings
+# --------------------------------------------------------------------------------
+
+# Routes, by (method, path), that run to the end even if their client disconnects,
+# because their side effects must not be interrupted halfway.
+CANCEL_ON_DISCONNECT_EXEMPT: frozenset = frozenset([
+    ("POST", "/extensions/path_deps"),  # Notifies every subscribed page
+])
+
+# Set for the duration of each request, for the work it offloads to threads.
+request_cancelled: contextvars.ContextVar[Optional[threading.Event]] = contextvars.ContextVar(
+    "request_cancelled", default=None
+)
+
+
+def cancelled() -> bool:
+    """
+    Returns True once the client of the current request has disconnected.
+    Work running in a thread cannot be cancelled from the outside: a long sync
+    handler or offloaded function polls this and returns early instead.
+    """
+    event: Optional[threading.Event] = request_cancelled.get()
+    return event is not None and event.is_set()
+
+
+# --------------------------------------------------------------------------------
+# Abandoned request statistics
+# --------------------------------------------------------------------------------
+class AbandonedRequests:
+    def __init__(self):
+        """
+        Counts the requests whose client disconnected before the response was sent,
+        overall and per route.
+        """
+        self.stats: Dict[str, int] = {"abandoned": 0, "cancelled": 0, "finished": 0}
+        self.routes: Dict[str, int] = {}
+
+    def record(self, method: str, path: str, cancelled: bool) -> None:
+        """
+        Counts one abandoned request, cancelled or left to finish.
+        """
+        self.stats["abandoned"] += 1
+        self.stats["cancelled" if cancelled else "finished"] += 1
+        route: str = f"{method} {path}"
+        self.routes[route] = self.routes.get(route, 0) + 1
+
+    def snapshot(self) -> dict:
+        """
+        Returns the counters and the abandoned requests per route.
+        """
+        return {**self.stats, "routes": dict(self.routes)}
+
+
+# --------------------------------------------------------------------------------
+# Disconnect middleware
+# --------------------------------------------------------------------------------
+class CancelOnDisconnectMiddleware:
+    def __init__(
+        self,
+        app: ASGIApp,
+        exempt: frozenset = CANCEL_ON_DISCONNECT_EXEMPT,
+        abandoned: Optional[AbandonedRequests] = None,
+    ):
+        """
+        Runs each HTTP request in its own task while another task listens on the
+        receive channel. If `http.disconnect` arrives before the response has started,
+        the request task is cancelled and the request's cancel flag is set for its
+        thread work. Exempt routes are only counted. Streaming responses (SSE) that the
+        client closes are not abandoned: they see the disconnect and end themselves.
+        """
+        self.app: ASGIApp = app
+        self.exempt: frozenset = exempt
+        self.abandoned: AbandonedRequests = abandoned_requests if abandoned is None else abandoned
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # The listener reads every message as it arrives; the request task reads them
+        # from this queue. Request bodies here are small form posts, so buffering is fine.
+        messages: asyncio.Queue = asyncio.Queue()
+        response_started: bool = False
+        cancel: threading.Event = threading.Event()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        async def listen() -> None:
+            while True:
+                message: Message = await receive()
+                messages.put_nowait(message)
+                if message["type"] == "http.disconnect":
+                    return
+
+        # The request task copies the context, so the cancel flag reaches its threads
+        token = request_cancelled.set(cancel)
+        handler: asyncio.Task = asyncio.ensure_future(self.app(scope, messages.get, send_wrapper))
+        request_cancelled.reset(token)
+        listener: asyncio.Task = asyncio.ensure_future(listen())
+        try:
+            await asyncio.wait({handler, listener}, return_when=asyncio.FIRST_COMPLETED)
+            disconnected: bool = listener.done() and listener.exception() is None
+            if disconnected and not handler.done() and not response_started:
+                # The client left before the response was sent
+                exempt: bool = (scope["method"], scope["path"]) in self.exempt
+                self.abandoned.record(scope["method"], scope["path"], cancelled=not exempt)
+                scope["abandoned"] = True
+                if not exempt:
+                    cancel.set()
+                    handler.cancel()
+            await asyncio.wait({handler})
+            if not handler.cancelled():
+                handler.result()
+        finally:
+            listener.cancel()
+            handler.cancel()
+
+
+# Initialize the abandoned request statistics instance
+abandoned_requests: AbandonedRequests = AbandonedRequests()
@@ -0,0 +1,174 @@
+"""
+This module watches the event loop for stalls.
+Every async handler, SSE generator and WebSocket loop of a worker shares one event
+loop, so a single blocking call delays all of them. A watchdog task measures how
+late the loop wakes it up, and a helper thread captures the loop thread's stack
+while the loop is stuck, so the blocking call can be found.
+"""
+
+# --------------------------------------------------------------------------------
+# Imports
+# --------------------------------------------------------------------------------
+
+import asyncio
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Deque, Dict, List, Optional
+
+
+# --------------------------------------------------------------------------------
+# Settings
+# --------------------------------------------------------------------------------
+
+# Seconds between two scheduling delay measurements.
+LAG_CHECK_INTERVAL: float = 0.1
+# Scheduling delay, in seconds, from which the loop counts as stalled.
+LAG_STALL_THRESHOLD: float = 0.25
+# Measurements the percentiles are computed over (one minute at the default interval).
+LAG_SAMPLE_WINDOW: int = 600
+# At most one stall is reported per interval (seconds); the others are only counted.
+LAG_REPORT_INTERVAL: float = 30.0
+# Reports kept for the diagnostics endpoint.
+LAG_REPORTS_KEPT: int = 20
+
+logger: logging.Logger = logging.getLogger("app.lag")
+
+
+# --------------------------------------------------------------------------------
+# Loop lag monitor
+# --------------------------------------------------------------------------------
+class LagMonitor:
+    def __init__(
+        self,
+        interval: float = LAG_CHECK_INTERVAL,
+        threshold: float = LAG_STALL_THRESHOLD,
+        window: int = LAG_SAMPLE_WINDOW,
+        report_interval: float = LAG_REPORT_INTERVAL,
+    ):
+        """
+        Measures the scheduling delay of the event loop: a task sleeps `interval`
+        seconds and records how late it wakes up. A helper thread checks the task's
+        heartbeat; when it is more than `threshold` seconds late the loop is blocked,
+        and the thread takes the loop thread's stack while the blocking call is
+        still running.
+        """
+        self.interval: float = interval
+        self.threshold: float = threshold
+        self.report_interval: float = report_interval
+        self._samples: Deque[float] = collections.deque(maxlen=window)
+        self.reports: Deque[dict] = collections.deque(maxlen=LAG_REPORTS_KEPT)
+        self.stats: Dict[str, int] = {"stalls": 0, "reported": 0, "suppressed": 0}
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping: threading.Event = threading.Event()
+        self._loop_thread_id: Optional[int] = None
+        self._beat: float = 0.0
+        self._stack: Optional[List[str]] = None  # Captured by the helper thread
+        self._last_report: Optional[float] = None
+
+    def start(self) -> None:
+        """
+        Starts the watchdog task on the running loop and the helper thread.
+        """
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopping.clear()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        self._thread = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        """
+        Stops the watchdog task and the helper thread.
+        """
+        if self._task is None:
+            return
+        self._stopping.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._thread.join()
+        self._thread = None
+
+    async def _run(self) -> None:
+        """
+        Sleeps `interval` seconds at a time and records how late each wake-up is.
+        """
+        while True:
+            expected: float = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self._beat = time.monotonic()
+            self.record(max(0.0, self._beat - expected))
+
+    def _watch(self) -> None:
+        """
+        Runs on the helper thread: captures the loop thread's stack once per stall.
+        """
+        while not self._stopping.wait(self.threshold / 2):
+            if self._stack is None and time.monotonic() - self._beat > self.interval + self.threshold:
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is not None:
+                    self._stack = traceback.format_stack(frame)
+
+    def record(self, lag: float) -> None:
+        """
+        Adds a scheduling delay measurement and reports it if it is a stall.
+        """
+        self._samples.append(lag)
+        stack, self._stack = self._stack, None
+        if lag < self.threshold:
+            return
+        self.stats["stalls"] += 1
+        now: float = time.monotonic()
+        if self._last_report is not None and now - self._last_report < self.report_interval:
+            self.stats["suppressed"] += 1
+            return
+        self._last_report = now
+        self.stats["reported"] += 1
+        report: dict = {
+            "at": time.time(),
+            "lag_ms": round(lag * 1000, 3),
+            "stack": stack or [],
+        }
+        self.reports.append(report)
+        logger.warning(
+            "Event loop blocked for %.0f ms%s",
+            lag * 1000,
+            ", blocking call:\n" + "".join(stack) if stack else "",
+            extra={"fields": {"lag_ms": report["lag_ms"]}},
+        )
+
+    def percentiles(self) -> Dict[str, Optional[float]]:
+        """
+        Returns the p50/p95/p99/max of the recent scheduling delays, in milliseconds.
+        """
+        if not self._samples:
+            return {"p50": None, "p95": None, "p99": None, "max": None}
+        values: List[float] = sorted(self._samples)
+        pick = lambda q: round(values[min(len(values) - 1, int(len(values) * q))] * 1000, 3)
+        return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": pick(1.0)}
+
+    def snapshot(self) -> dict:
+        """
+        Returns the lag percentiles, the stall counters and the recent stall reports.
+        """
+        return {
+            "samples": len(self._samples),
+            "lag_ms": self.percentiles(),
+            "threshold_ms": round(self.threshold * 1000, 3),
+            **self.stats,
+            "reports": list(self.reports),
+        }
+
+
+# Initialize the loop lag monitor instance
+lag_monitor: LagMonitor = LagMonitor()
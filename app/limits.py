@@ -0,0 +1,181 @@
+"""
+This module caps how many requests to a slow route run at once.
+Each limited route has a number of slots and a bounded FIFO queue of requests
+waiting for one; requests that find the queue full, or wait too long, are shed
+with a 503 and a retry hint instead of piling up in the worker.
+"""
+
+# --------------------------------------------------------------------------------
+# Imports
+# --------------------------------------------------------------------------------
+
+import asyncio
+import collections
+import json
+from typing import Deque, Dict, Optional, Tuple
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+
+# --------------------------------------------------------------------------------
+# Settings
+# --------------------------------------------------------------------------------
+
+# Concurrency limits per (method, path):
+#   limit: requests running at once
+#   queue: requests waiting for a slot, in arrival order
+#   max_wait: seconds a request waits in the queue before it is shed
+#   retry_after: seconds a shed client is told to wait before retrying
+CONCURRENCY_LIMITS: Dict[Tuple[str, str], dict] = {
+    ("POST", "/extensions/loading_states"): {"limit": 8, "queue": 16, "max_wait": 2.0, "retry_after": 5},
+    ("GET", "/builtin/htmx_headers"): {"limit": 16, "queue": 32, "max_wait": 1.0, "retry_after": 1},
+    ("GET", "/builtin/sync_first"): {"limit": 16, "queue": 32, "max_wait": 1.0, "retry_after": 2},
+    ("GET", "/builtin/sync_second"): {"limit": 16, "queue": 32, "max_wait": 1.0, "retry_after": 2},
+}
+# Event sent to htmx clients with a shed response, on the element that made the request.
+SHED_HTMX_EVENT: str = "server-busy"
+
+
+# --------------------------------------------------------------------------------
+# Concurrency limit
+# --------------------------------------------------------------------------------
+class ConcurrencyLimit:
+    def __init__(self, limit: int, queue: int, max_wait: float, retry_after: int):
+        """
+        A counting semaphore with a bounded FIFO wait queue. A released slot is handed
+        directly to the oldest waiter, so a request arriving later cannot overtake it.
+        """
+        self.limit: int = limit
+        self.queue_size: int = queue
+        self.max_wait: float = max_wait
+        self.retry_after: int = retry_after
+        self.active: int = 0
+        self._waiters: Deque[asyncio.Future] = collections.deque()
+        self.stats: Dict[str, int] = {"admitted": 0, "queued": 0, "shed_full": 0, "shed_timeout": 0}
+
+    async def acquire(self) -> bool:
+        """
+        Takes a slot, waiting in the queue if needed. Returns False when the request
+        is shed: the queue is full, or no slot was freed within `max_wait` seconds.
+        """
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.stats["admitted"] += 1
+            return True
+        if len(self._waiters) >= self.queue_size:
+            self.stats["shed_full"] += 1
+            return False
+
+        self.stats["queued"] += 1
+        waiter: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except BaseException as error:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the wait ended
+                if not isinstance(error, asyncio.TimeoutError):
+                    self.release()
+                    raise
+            else:
+                # release() drops cancelled waiters itself, possibly in the same loop turn
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                if not isinstance(error, asyncio.TimeoutError):
+                    raise
+                self.stats["shed_timeout"] += 1
+                return False
+        self.stats["admitted"] += 1
+        return True
+
+    def release(self) -> None:
+        """
+        Frees a slot, handing it to the oldest waiter if there is one.
+        """
+        while self._waiters:
+            waiter: asyncio.Future = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def snapshot(self) -> dict:
+        """
+        Returns the limit, the current load and the counters.
+        """
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queue_depth": len(self._waiters),
+            "queue_size": self.queue_size,
+            "max_wait": self.max_wait,
+            **self.stats,
+        }
+
+
+class RouteLimits:
+    def __init__(self, limits: Dict[Tuple[str, str], dict] = CONCURRENCY_LIMITS):
+        """
+        Holds one ConcurrencyLimit per limited (method, path).
+        """
+        self._limits: Dict[Tuple[str, str], ConcurrencyLimit] = {
+            route: ConcurrencyLimit(**settings) for route, settings in limits.items()
+        }
+
+    def get(self, method: str, path: str) -> Optional[ConcurrencyLimit]:
+        """
+        Returns the limit of a route, or None if the route is not limited.
+        """
+        return self._limits.get((method, path))
+
+    def snapshot(self) -> Dict[str, dict]:
+        """
+        Returns the state of every limit, keyed by "METHOD /path".
+        """
+        return {f"{method} {path}": limit.snapshot() for (method, path), limit in self._limits.items()}
+
+
+# --------------------------------------------------------------------------------
+# Concurrency limit middleware
+# --------------------------------------------------------------------------------
+class ConcurrencyLimitMiddleware:
+    def __init__(self, app: ASGIApp, limits: Optional[RouteLimits] = None):
+        """
+        Runs the requests to limited routes within their route's concurrency limit,
+        and sheds the rest with a 503. Other routes are not affected.
+        """
+        self.app: ASGIApp = app
+        self.limits: RouteLimits = route_limits if limits is None else limits
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        limit: Optional[ConcurrencyLimit] = None
+        if scope["type"] == "http":
+            limit = self.limits.get(scope["method"], scope["path"])
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not await limit.acquire():
+            await self._shed(scope, send, limit)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limit.release()
+
+    @staticmethod
+    async def _shed(scope: Scope, send: Send, limit: ConcurrencyLimit) -> None:
+        """
+        Sends a 503 with Retry-After. htmx does not swap error responses, so htmx
+        requests also get an event telling the page when to retry.
+        """
+        headers = [(b"retry-after", str(limit.retry_after).encode()), (b"content-length", b"0")]
+        if dict(scope["headers"]).get(b"hx-request") == b"true":
+            trigger: str = json.dumps({SHED_HTMX_EVENT: {"retryAfter": limit.retry_after}})
+            headers.append((b"hx-trigger", trigger.encode()))
+        await send({"type": "http.response.start", "status": 503, "headers": headers})
+        await send({"type": "http.response.body", "body": b""})
+
+
+# Initialize the route limits instance
+route_limits: RouteLimits = RouteLimits()
@@ -0,0 +1,228 @@
+"""
+This module sets up the application-wide logging.
+Records are handed to a queue on the event loop thread and formatted and written
+by a background listener thread, so logging never blocks the loop on console I/O.
+It also provides sampled, structured access logging and duplicate suppression.
+"""
+
+# --------------------------------------------------------------------------------
+# Imports
+# --------------------------------------------------------------------------------
+
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+# --------------------------------------------------------------------------------
+# Settings
+# --------------------------------------------------------------------------------
+
+# Loggers routed through the queue. The application loggers live under "app",
+# uvicorn configures its own loggers with propagate=False.
+QUEUED_LOGGERS: Tuple[str, ...] = ("app", "uvicorn", "uvicorn.error")
+# Loggers left without any handler. uvicorn logs each request to "uvicorn.access"
+# whenever that logger has a handler, even with access_log=False; the sampled
+# "app.access" records replace it.
+SILENCED_LOGGERS: Tuple[str, ...] = ("uvicorn.access",)
+LOG_FORMAT: str = "%(asctime)s - %(levelname)s - %(name)s - %(message)s"
+
+# Identical messages (same logger, level and message template) allowed per window;
+# the rest are dropped and counted on the next message that gets through.
+DUPLICATE_LIMIT: int = 10
+DUPLICATE_WINDOW: float = 5.0
+# Loggers left out of the duplicate filter. Every access record has the same message
+# template; the access log is thinned by its own sampling instead.
+DUPLICATE_EXEMPT_LOGGERS: frozenset = frozenset(["app.access"])
+
+# Fraction of requests logged per route path. Server errors are always logged.
+ACCESS_LOG_SAMPLE_RATES: Dict[str, float] = {
+    "/builtin/vals_example": 0.1,  # One request per keystroke
+    "/extensions/sse_event_triggered": 0.1,
+    "/extensions/connections": 0.0,
+    "/extensions/loop_lag": 0.0,
+    "/extensions/concurrency": 0.0,
+    "/extensions/abandoned": 0.0,
+    "/extensions/preload_cache": 0.0,
+}
+ACCESS_LOG_DEFAULT_RATE: float = 1.0
+
+
+# --------------------------------------------------------------------------------
+# Handlers, filters and formatters
+# --------------------------------------------------------------------------------
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that enqueues the record untouched.
+    The standard QueueHandler merges the arguments into the message on the calling
+    thread; here all formatting is left to the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class DuplicateFilter(logging.Filter):
+    def __init__(self, limit: int = DUPLICATE_LIMIT, window: float = DUPLICATE_WINDOW):
+        """
+        Rate-limits repeated messages: at most `limit` records with the same logger,
+        level and message template get through per `window` seconds.
+        The message template is compared, not the formatted message, so the check
+        costs a dict lookup and no formatting.
+        """
+        super().__init__()
+        self.limit: int = limit
+        self.window: float = window
+        # key -> [window start, records seen in the window]
+        self._seen: Dict[Tuple[str, int, object], List] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.name in DUPLICATE_EXEMPT_LOGGERS:
+            return True
+        key = (record.name, record.levelno, record.msg)
+        now: float = time.monotonic()
+        seen = self._seen.get(key)
+        if seen is None or now - seen[0] >= self.window:
+            if seen is not None and seen[1] > self.limit:
+                record.suppressed = seen[1] - self.limit
+            if len(self._seen) > 10000:
+                # Forget the old windows instead of growing without bound
+                self._seen.clear()
+            self._seen[key] = [now, 1]
+            return True
+        seen[1] += 1
+        return seen[1] <= self.limit
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formatter that appends the record's structured `fields` as key=value pairs,
+    and the number of duplicates suppressed before it.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        message: str = super().format(record)
+        fields: Optional[Dict[str, object]] = getattr(record, "fields", None)
+        if fields:
+            message += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        suppressed: Optional[int] = getattr(record, "suppressed", None)
+        if suppressed:
+            message += f" (suppressed {suppressed} similar messages)"
+        return message
+
+
+# --------------------------------------------------------------------------------
+# Queue logging
+# --------------------------------------------------------------------------------
+class QueueLogging:
+    def __init__(self, handler: Optional[logging.Handler] = None):
+        """
+        Routes the QUEUED_LOGGERS through a queue to a background listener thread,
+        which owns the real (blocking) handler.
+        """
+        if handler is None:
+            handler = logging.StreamHandler(sys.stderr)
+            handler.setFormatter(StructuredFormatter(LOG_FORMAT))
+        self.handler: logging.Handler = handler
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._previous: Dict[str, Tuple[List[logging.Handler], bool]] = {}
+
+    def start(self) -> None:
+        """
+        Starts the listener thread and swaps the loggers' handlers for the queue handler.
+        The SILENCED_LOGGERS lose their handlers and stop propagating.
+        """
+        if self._listener is not None:
+            return
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        queue_handler = DeferredQueueHandler(log_queue)
+        queue_handler.addFilter(DuplicateFilter())
+        self._listener = logging.handlers.QueueListener(log_queue, self.handler, respect_handler_level=True)
+        self._listener.start()
+        for name in QUEUED_LOGGERS:
+            logger = logging.getLogger(name)
+            self._previous[name] = (logger.handlers[:], logger.propagate)
+            logger.handlers = [queue_handler]
+            logger.propagate = False
+        for name in SILENCED_LOGGERS:
+            logger = logging.getLogger(name)
+            self._previous[name] = (logger.handlers[:], logger.propagate)
+            logger.handlers = []
+            logger.propagate = False
+        logging.getLogger("app").setLevel(logging.INFO)
+
+    def stop(self) -> None:
+        """
+        Restores the previous handlers, then writes out the queued records and stops the listener.
+        """
+        if self._listener is None:
+            return
+        for name, (handlers, propagate) in self._previous.items():
+            logger = logging.getLogger(name)
+            logger.handlers = handlers
+            logger.propagate = propagate
+        self._previous.clear()
+        self._listener.stop()
+        self._listener = None
+
+
+# --------------------------------------------------------------------------------
+# Access logging
+# --------------------------------------------------------------------------------
+access_logger: logging.Logger = logging.getLogger("app.access")
+
+
+class AccessLogMiddleware:
+    def __init__(self, app: ASGIApp, sample_rates: Optional[Dict[str, float]] = None, default_rate: float = ACCESS_LOG_DEFAULT_RATE):
+        """
+        Logs one structured record per HTTP request, sampled per route path.
+        Each record carries its sample rate, so counts can be scaled back up.
+        """
+        self.app: ASGIApp = app
+        self.sample_rates: Dict[str, float] = ACCESS_LOG_SAMPLE_RATES if sample_rates is None else sample_rates
+        self.default_rate: float = default_rate
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start: float = time.perf_counter()
+        status: Optional[int] = None
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if status is None:
+                # No response: 499 if the client went away first (see app.disconnect)
+                status = 499 if scope.get("abandoned") else 500
+            route = scope.get("route")
+            path: str = getattr(route, "path", scope["path"])
+            rate: float = self.sample_rates.get(path, self.default_rate)
+            if status >= 500 or (rate > 0 and (rate >= 1 or random.random() < rate)):
+                access_logger.info(
+                    "access",
+                    extra={"fields": {
+                        "method": scope["method"],
+                        "path": path,
+                        "status": status,
+                        "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+                        "sample_rate": 1.0 if status >= 500 else rate,
+                    }},
+                )
+
+
+# Initialize the queue logging instance
+queue_logging: QueueLogging = QueueLogging()
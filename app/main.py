@@ -1,9 +1,11 @@
 # Importing necessary libraries and modules
 import os
 import sys
+from contextlib import asynccontextmanager
 import uvicorn  # Uvicorn ASGI server for FastAPI
 from fastapi import FastAPI  # FastAPI framework
 from fastapi.staticfiles import StaticFiles  # To serve static files
+from sse_starlette.sse import unpatch_uvicorn_signal_handler  # To let SSE streams drain on shutdown
 
 # Adding the parent directory of the current script to the system path
 # This allows importing modules from the parent directory
@@ -12,9 +14,38 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 # Importing the routers from the 'app.routers' module
 # These routers define the endpoints for different parts of the application
 from app.routers import builtin, extensions, root
+from app.chatlog import chat_log
+from app.disconnect import CancelOnDisconnectMiddleware
+from app.lag import lag_monitor
+from app.limits import ConcurrencyLimitMiddleware
+from app.log import AccessLogMiddleware, queue_logging
+from app.preload import PreloadCacheMiddleware
+
+# Lifespan of the application
+# Starts the background tasks on startup and stops them on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    queue_logging.start()  # Writes log records from a background thread
+    lag_monitor.start()  # Reports event-loop stalls and the blocking call's stack
+    extensions.reaper.start()  # Sweeps idle WebSocket connections
+    await chat_log.start()  # Opens the chat log and syncs it to disk in batches
+    yield
+    await chat_log.stop()
+    await extensions.reaper.stop()
+    await lag_monitor.stop()
+    queue_logging.stop()
 
 # Initializing the FastAPI application
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# Caps the requests running at once on slow routes and sheds the excess with a 503
+app.add_middleware(ConcurrencyLimitMiddleware)
+# Serves the real request after an htmx preload from the preloaded response
+app.add_middleware(PreloadCacheMiddleware)
+# Cancels the handlers of requests whose client disconnected, queued ones included
+app.add_middleware(CancelOnDisconnectMiddleware)
+# Structured access logging, sampled per route
+app.add_middleware(AccessLogMiddleware)
 
 # Including the routers for different parts of the application
 app.include_router(root.router)       # Root router, handles main endpoints
@@ -29,10 +60,23 @@ app.mount(
     name="static",                    # A name for the static file mount
 )
 
+# Uvicorn server that drains the long-lived connections before shutting down
+# The listening socket stays open while draining, so new long-lived connections
+# are refused with a retry hint instead of failing to connect
+class DrainingServer(uvicorn.Server):
+    async def shutdown(self, sockets=None) -> None:
+        await extensions.drainer.drain()  # Waits at most DRAIN_DEADLINE seconds
+        await super().shutdown(sockets=sockets)
+
 # The main function to run the Uvicorn server
 # This will start the application on the specified host and port
 def main() -> None:
-    uvicorn.run(app, host="localhost", port=8000)  # Running the app on localhost:8000
+    # sse-starlette ends every SSE stream as soon as the exit signal arrives;
+    # let the drainer end them with a randomized retry instead
+    unpatch_uvicorn_signal_handler()
+    # The access log comes from AccessLogMiddleware, sampled per route
+    config = uvicorn.Config(app, host="localhost", port=8000, access_log=False)  # Running the app on localhost:8000
+    DrainingServer(config).run()
 
 # Entry point for the script
 # This runs the FastAPI app when the script is executed directly
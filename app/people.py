@@ -0,0 +1,353 @@
+"""
+This module holds the list of people shown on the index page.
+Records are kept with a pre-sorted index, so any page of the list can be
+fetched by cursor (keyset pagination) at the cost of a binary search.
+It also keeps a search index over the names and ages, updated on every change.
+"""
+
+# --------------------------------------------------------------------------------
+# Imports
+# --------------------------------------------------------------------------------
+
+import base64
+import bisect
+import json
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+
+# --------------------------------------------------------------------------------
+# Settings
+# --------------------------------------------------------------------------------
+
+# Rows per page of the people list, and the largest page a client may ask for.
+PEOPLE_PAGE_SIZE: int = 50
+PEOPLE_PAGE_MAX: int = 200
+
+# Results per search, and the largest number a client may ask for.
+SEARCH_LIMIT: int = 20
+SEARCH_LIMIT_MAX: int = 100
+# Number of recent search results kept.
+SEARCH_CACHE_SIZE: int = 128
+
+SortKey = Tuple[str, int]
+AgeKey = Tuple[int, str, int]
+
+
+# --------------------------------------------------------------------------------
+# People store
+# --------------------------------------------------------------------------------
+class PeopleStore:
+    def __init__(self, people: Iterable[dict] = ()):
+        """
+        Stores people records ({"id", "name", "age"}) by id, plus an index of their
+        sort keys (case-folded name, id) kept sorted on every change.
+        """
+        self._records: Dict[int, dict] = {}
+        self._order: List[SortKey] = []
+        self._next_id: int = 1
+        # Called with ("add" | "remove", person) after every change
+        self.listeners: List[Callable[[str, dict], None]] = []
+        for person in people:
+            self.add(person["name"], person["age"])
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    @staticmethod
+    def sort_key(person: dict) -> SortKey:
+        """
+        Returns the key the list is ordered by: name, then id to break ties.
+        """
+        return (person["name"].casefold(), person["id"])
+
+    def add(self, name: str, age: int) -> dict:
+        """
+        Adds a person and returns the stored record.
+        """
+        person: dict = {"id": self._next_id, "name": name, "age": age}
+        self._next_id += 1
+        self._records[person["id"]] = person
+        bisect.insort(self._order, self.sort_key(person))
+        for listener in self.listeners:
+            listener("add", person)
+        return person
+
+    def remove(self, person_id: int) -> Optional[dict]:
+        """
+        Removes a person by id and returns the removed record, if any.
+        """
+        person: Optional[dict] = self._records.pop(person_id, None)
+        if person is None:
+            return None
+        key: SortKey = self.sort_key(person)
+        del self._order[bisect.bisect_left(self._order, key)]
+        for listener in self.listeners:
+            listener("remove", person)
+        return person
+
+    def get(self, person_id: int) -> Optional[dict]:
+        """
+        Returns a person by id.
+        """
+        return self._records.get(person_id)
+
+    def __iter__(self) -> Iterator[dict]:
+        """
+        Iterates over the people in list order.
+        """
+        return (self._records[person_id] for _, person_id in self._order)
+
+    def prefix_range(self, prefix: str) -> Tuple[int, int]:
+        """
+        Returns the slice of the sorted index holding the names that start with the
+        case-folded `prefix`.
+        """
+        start: int = bisect.bisect_left(self._order, (prefix,))
+        end: int = bisect.bisect_left(self._order, (prefix + "\U0010ffff",))
+        return start, end
+
+    def keys(self, start: int, end: int) -> Iterator[SortKey]:
+        """
+        Iterates lazily over a slice of the sorted index.
+        """
+        return (self._order[index] for index in range(start, end))
+
+    def page(self, cursor: Optional[str] = None, limit: int = PEOPLE_PAGE_SIZE) -> Tuple[List[dict], Optional[str]]:
+        """
+        Returns up to `limit` people following `cursor` in list order, and the cursor
+        of the next page (None on the last page). Raises ValueError for a bad cursor.
+        """
+        start: int = 0
+        if cursor:
+            start = bisect.bisect_right(self._order, self.decode_cursor(cursor))
+        keys: List[SortKey] = self._order[start:start + limit]
+        rows: List[dict] = [self._records[person_id] for _, person_id in keys]
+        has_more: bool = start + limit < len(self._order)
+        return rows, self.encode_cursor(keys[-1]) if keys and has_more else None
+
+    @staticmethod
+    def encode_cursor(key: SortKey) -> str:
+        """
+        Encodes a sort key into an opaque, URL-safe cursor.
+        """
+        return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> SortKey:
+        """
+        Decodes a cursor back into its sort key.
+        """
+        try:
+            name, person_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+            return (str(name), int(person_id))
+        except (ValueError, TypeError) as error:
+            raise ValueError(f"Invalid cursor: {cursor!r}") from error
+
+
+# --------------------------------------------------------------------------------
+# People search index
+# --------------------------------------------------------------------------------
+def trigrams(text: str) -> Set[str]:
+    """
+    Returns the three-character substrings of a text.
+    """
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class PeopleSearchIndex:
+    def __init__(self, store: PeopleStore, cache_size: int = SEARCH_CACHE_SIZE):
+        """
+        Indexes the names of a store by trigram and the people by age, once, then
+        follows the store's changes. Every posting list is kept sorted in list order,
+        so a search walks the shortest list and stops as soon as it has enough results.
+        """
+        self.store: PeopleStore = store
+        self.cache_size: int = cache_size
+        self._trigrams: Dict[str, List[SortKey]] = {}
+        self._ages: List[AgeKey] = []
+        self._cache: Dict[Tuple, List[dict]] = {}
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0}
+        # Build once in bulk: append everything, then sort each list a single time
+        for person in store:
+            key: SortKey = PeopleStore.sort_key(person)
+            for trigram in trigrams(key[0]):
+                self._trigrams.setdefault(trigram, []).append(key)
+            self._ages.append((person["age"],) + key)
+        for postings in self._trigrams.values():
+            postings.sort()
+        self._ages.sort()
+        store.listeners.append(self._on_change)
+
+    def _on_change(self, change: str, person: dict) -> None:
+        """
+        Updates the index for one changed person and forgets the cached results.
+        """
+        if change == "add":
+            self._add(person)
+        else:
+            self._remove(person)
+        self._cache.clear()
+
+    def _add(self, person: dict) -> None:
+        """
+        Adds a person to the trigram and age indexes.
+        """
+        key: SortKey = PeopleStore.sort_key(person)
+        for trigram in trigrams(key[0]):
+            bisect.insort(self._trigrams.setdefault(trigram, []), key)
+        bisect.insort(self._ages, (person["age"],) + key)
+
+    def _remove(self, person: dict) -> None:
+        """
+        Removes a person from the trigram and age indexes.
+        """
+        key: SortKey = PeopleStore.sort_key(person)
+        for trigram in trigrams(key[0]):
+            postings: List[SortKey] = self._trigrams[trigram]
+            del postings[bisect.bisect_left(postings, key)]
+            if not postings:
+                del self._trigrams[trigram]
+        age_key: AgeKey = (person["age"],) + key
+        del self._ages[bisect.bisect_left(self._ages, age_key)]
+
+    def search(
+        self,
+        query: str = "",
+        min_age: Optional[int] = None,
+        max_age: Optional[int] = None,
+        limit: int = SEARCH_LIMIT,
+    ) -> List[dict]:
+        """
+        Returns up to `limit` people whose name matches `query` (names starting with
+        it first, then in list order) and whose age is within [min_age, max_age].
+        Queries shorter than a trigram only match the start of names.
+        Without a query the people in the age range are returned in age order.
+        Recent results are answered from a small LRU cache.
+        """
+        cache_key: Tuple = (query.casefold().strip(), min_age, max_age, limit)
+        results: Optional[List[dict]] = self._cache.pop(cache_key, None)
+        if results is not None:
+            self.stats["hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            results = [self.store.get(person_id) for _, person_id in self._search(*cache_key)]
+            if len(self._cache) >= self.cache_size:
+                del self._cache[next(iter(self._cache))]
+        # Re-inserting moves the entry to the end: the dict stays in least recently used order
+        self._cache[cache_key] = results
+        return results
+
+    def _age_range(self, min_age: Optional[int], max_age: Optional[int]) -> Tuple[int, int]:
+        """
+        Returns the slice of the age index within [min_age, max_age].
+        """
+        start: int = 0 if min_age is None else bisect.bisect_left(self._ages, (min_age,))
+        end: int = len(self._ages) if max_age is None else bisect.bisect_left(self._ages, (max_age + 1,))
+        return start, max(start, end)
+
+    @staticmethod
+    def matches(query: str, name: str) -> bool:
+        """
+        Returns True if a case-folded name matches the query: it starts with the query,
+        or, for queries of at least three characters, contains it.
+        """
+        return name.startswith(query) or (len(query) >= 3 and query in name)
+
+    def _search(self, query: str, min_age: Optional[int], max_age: Optional[int], limit: int) -> List[SortKey]:
+        """
+        Returns the sort keys of the matching people. Takes the plan that walks the
+        fewest rows: the age range (see _scan_ages), or the names starting with the
+        query followed by the shortest trigram posting list of the names containing
+        it, walked until `limit` people in the age range are found.
+        """
+        age_start, age_end = self._age_range(min_age, max_age)
+        if not query:
+            return [age_key[1:] for age_key in self._ages[age_start:min(age_end, age_start + limit)]]
+
+        prefix_start, prefix_end = self.store.prefix_range(query)
+        shortest: List[SortKey] = []
+        if len(query) >= 3:
+            shortest = min((self._trigrams.get(trigram, []) for trigram in trigrams(query)), key=len)
+
+        ages_filtered: bool = min_age is not None or max_age is not None
+        if ages_filtered:
+            # Rows each plan walks, assuming names and ages are independent: one name
+            # candidate in len(ages) / age_rows has an age in range, and one person in
+            # len(ages) / candidates of each age matches the query
+            size: int = len(self._ages)
+            age_rows: int = age_end - age_start
+            candidates: int = (prefix_end - prefix_start) + len(shortest)
+            runs: int = self._ages[age_end - 1][0] - self._ages[age_start][0] + 1 if age_rows else 0
+            name_rows: int = min(candidates, limit * size // max(1, age_rows))
+            if len(query) < 3:
+                age_walk: int = runs
+            else:
+                age_walk = min(age_rows, runs * limit * size // max(1, candidates))
+            if age_walk < name_rows:
+                return self._scan_ages(query, age_start, age_end, limit)
+
+        def in_age_range(key: SortKey) -> bool:
+            if not ages_filtered:
+                return True
+            age: int = self.store.get(key[1])["age"]
+            return (min_age is None or age >= min_age) and (max_age is None or age <= max_age)
+
+        results: List[SortKey] = []
+        for key in self.store.keys(prefix_start, prefix_end):
+            if in_age_range(key):
+                results.append(key)
+                if len(results) == limit:
+                    return results
+        for key in shortest:
+            if query in key[0] and not key[0].startswith(query) and in_age_range(key):
+                results.append(key)
+                if len(results) == limit:
+                    break
+        return results
+
+
+    def _scan_ages(self, query: str, start: int, end: int, limit: int) -> List[SortKey]:
+        """
+        Returns the sort keys of the matching people within a slice of the age index.
+        The slice holds one run per age, each sorted in list order: the names starting
+        with the query are found by binary search in each run, and a run is walked for
+        the names containing the query only until it has `limit` of them.
+        """
+        runs: List[Tuple[int, int]] = []
+        while start < end:
+            run_end: int = bisect.bisect_left(self._ages, (self._ages[start][0] + 1,), start, end)
+            runs.append((start, run_end))
+            start = run_end
+
+        results: List[SortKey] = []
+        for run_start, run_end in runs:
+            age: int = self._ages[run_start][0]
+            low: int = bisect.bisect_left(self._ages, (age, query), run_start, run_end)
+            high: int = bisect.bisect_left(self._ages, (age, query + "\U0010ffff"), low, run_end)
+            results.extend(age_key[1:] for age_key in self._ages[low:min(high, low + limit)])
+        results.sort()
+        if len(results) >= limit or len(query) < 3:
+            return results[:limit]
+
+        contained: List[SortKey] = []
+        for run_start, run_end in runs:
+            found: int = 0
+            for index in range(run_start, run_end):
+                age_key: AgeKey = self._ages[index]
+                if query in age_key[1] and not age_key[1].startswith(query):
+                    contained.append(age_key[1:])
+                    found += 1
+                    if found == limit:
+                        break
+        contained.sort()
+        return (results + contained)[:limit]
+
+# Initialize the people store with the example list of people
+people: PeopleStore = PeopleStore([
+    {"name": "Tom", "age": 10},
+    {"name": "Charles", "age": 5},
+    {"name": "Pam", "age": 7},
+])
+
+# Initialize the people search index
+search_index: PeopleSearchIndex = PeopleSearchIndex(people)
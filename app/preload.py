@@ -0,0 +1,220 @@
+"""
+This module keeps a short-lived, per-client cache of the responses to htmx preload
+requests, so the real request that follows the preload is served without running
+the route a second time.
+"""
+
+# --------------------------------------------------------------------------------
+# Imports
+# --------------------------------------------------------------------------------
+
+import asyncio
+import time
+from typing import Dict, List, Optional, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+# --------------------------------------------------------------------------------
+# Settings
+# --------------------------------------------------------------------------------
+
+# Routes that opt in to the preload cache. Only GET requests are cached, and a route
+# opts out of caching a particular response by sending `Cache-Control: no-store`.
+PRELOAD_CACHE_ROUTES: frozenset = frozenset([
+    "/extensions/loading_states",
+])
+# Seconds a preloaded response waits for its real request.
+PRELOAD_CACHE_TTL: float = 10.0
+# Memory bounds: responses larger than the entry limit are not kept, and the oldest
+# entries are evicted once the cache holds more than the total limit.
+PRELOAD_CACHE_MAX_ENTRY_BYTES: int = 64 * 1024
+PRELOAD_CACHE_MAX_BYTES: int = 4 * 1024 * 1024
+# Request headers that tell clients apart, in addition to the address. Clients behind
+# one proxy share an address, so the session cookie and credentials are part of the key.
+PRELOAD_CACHE_KEY_HEADERS: Tuple[bytes, ...] = (b"user-agent", b"cookie", b"authorization")
+
+CacheKey = Tuple[str, Tuple[bytes, ...], str, bytes]
+CachedResponse = Tuple[int, List[Tuple[bytes, bytes]], bytes]
+
+
+# --------------------------------------------------------------------------------
+# Preload cache
+# --------------------------------------------------------------------------------
+class PreloadCache:
+    def __init__(
+        self,
+        ttl: float = PRELOAD_CACHE_TTL,
+        max_entry_bytes: int = PRELOAD_CACHE_MAX_ENTRY_BYTES,
+        max_bytes: int = PRELOAD_CACHE_MAX_BYTES,
+    ):
+        """
+        Holds preloaded responses until their real request arrives, at most `ttl` seconds.
+        Every entry is served once. Entries share one TTL, so the insertion-ordered dict
+        is also ordered by expiry and eviction always removes from its front.
+        """
+        self.ttl: float = ttl
+        self.max_entry_bytes: int = max_entry_bytes
+        self.max_bytes: int = max_bytes
+        self._entries: Dict[CacheKey, Tuple[float, CachedResponse]] = {}
+        self._inflight: Dict[CacheKey, asyncio.Future] = {}
+        self._bytes: int = 0
+        self.stats: Dict[str, int] = {"preloads": 0, "stored": 0, "hits": 0, "misses": 0, "evictions": 0}
+
+    def hit_rate(self) -> Optional[float]:
+        """
+        Returns the fraction of real requests to cached routes served from the cache.
+        """
+        lookups: int = self.stats["hits"] + self.stats["misses"]
+        return round(self.stats["hits"] / lookups, 3) if lookups else None
+
+    def put(self, key: CacheKey, response: CachedResponse) -> None:
+        """
+        Stores a preloaded response, evicting expired and then oldest entries.
+        """
+        self.discard(key)
+        size: int = len(response[2])
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self._bytes += size
+        self.stats["stored"] += 1
+        self._evict()
+
+    def pop(self, key: CacheKey) -> Optional[CachedResponse]:
+        """
+        Removes and returns the unexpired response stored for a key.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._bytes -= len(entry[1][2])
+        if entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def discard(self, key: CacheKey) -> None:
+        """
+        Removes the response stored for a key, if any.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1][2])
+
+    def begin_preload(self, key: CacheKey) -> asyncio.Future:
+        """
+        Marks a preload as running and returns the future its response is published on.
+        """
+        self.stats["preloads"] += 1
+        inflight: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = inflight
+        return inflight
+
+    def end_preload(self, key: CacheKey, inflight: asyncio.Future, response: Optional[CachedResponse]) -> None:
+        """
+        Stores the response of a finished preload, if cacheable, and wakes the requests waiting for it.
+        """
+        if self._inflight.get(key) is inflight:
+            del self._inflight[key]
+        if response is not None:
+            self.put(key, response)
+        inflight.set_result(response)
+
+    async def take(self, key: CacheKey) -> Optional[CachedResponse]:
+        """
+        Returns the preloaded response for a real request, waiting for the preload
+        if it is still running, or None on a miss.
+        """
+        response: Optional[CachedResponse] = self.pop(key)
+        inflight: Optional[asyncio.Future] = self._inflight.get(key)
+        if response is None and inflight is not None:
+            # The preload started on mousedown and is still running: share its result
+            response = await asyncio.shield(inflight)
+            self.discard(key)
+        self.stats["hits" if response is not None else "misses"] += 1
+        return response
+
+    def _evict(self) -> None:
+        """
+        Drops expired entries and, while over the memory limit, the oldest ones.
+        """
+        now: float = time.monotonic()
+        while self._entries:
+            key, (expires_at, response) = next(iter(self._entries.items()))
+            if expires_at >= now and self._bytes <= self.max_bytes:
+                break
+            del self._entries[key]
+            self._bytes -= len(response[2])
+            self.stats["evictions"] += 1
+
+
+# --------------------------------------------------------------------------------
+# Preload cache middleware
+# --------------------------------------------------------------------------------
+class PreloadCacheMiddleware:
+    def __init__(self, app: ASGIApp, cache: Optional[PreloadCache] = None, routes: frozenset = PRELOAD_CACHE_ROUTES):
+        """
+        Recognizes htmx preload requests by their `HX-Preloaded` header, keeps their
+        response for the same client (address and identifying headers), and answers
+        the real request from it. A real request arriving while its preload is still
+        running waits for that preload.
+        """
+        self.app: ASGIApp = app
+        self.cache: PreloadCache = preload_cache if cache is None else cache
+        self.routes: frozenset = routes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] != "GET" or scope["path"] not in self.routes:
+            await self.app(scope, receive, send)
+            return
+
+        headers: Dict[bytes, bytes] = dict(scope["headers"])
+        client: str = scope["client"][0] if scope.get("client") else ""
+        identity: Tuple[bytes, ...] = tuple(headers.get(name, b"") for name in PRELOAD_CACHE_KEY_HEADERS)
+        key: CacheKey = (client, identity, scope["path"], scope["query_string"])
+
+        if headers.get(b"hx-preloaded") == b"true":
+            await self._preload(key, scope, receive, send)
+            return
+
+        cached: Optional[CachedResponse] = await self.cache.take(key)
+        if cached is None:
+            await self.app(scope, receive, send)
+            return
+
+        status, raw_headers, body = cached
+        await send({"type": "http.response.start", "status": status, "headers": raw_headers + [(b"x-preload-cache", b"hit")]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def _preload(self, key: CacheKey, scope: Scope, receive: Receive, send: Send) -> None:
+        """
+        Runs the route for a preload request and keeps a copy of its response.
+        """
+        inflight: asyncio.Future = self.cache.begin_preload(key)
+        start: Optional[Message] = None
+        chunks: List[bytes] = []
+        size: int = 0
+        cacheable: bool = True
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal start, size, cacheable
+            if message["type"] == "http.response.start":
+                start = message
+                cache_control: bytes = dict(message.get("headers", [])).get(b"cache-control", b"")
+                cacheable = message["status"] == 200 and b"no-store" not in cache_control
+            elif message["type"] == "http.response.body" and cacheable:
+                chunk: bytes = message.get("body", b"")
+                size += len(chunk)
+                cacheable = size <= self.cache.max_entry_bytes
+                chunks.append(chunk)
+            await send(message)
+
+        response: Optional[CachedResponse] = None
+        try:
+            await self.app(scope, receive, send_wrapper)
+            if cacheable and start is not None:
+                response = (start["status"], list(start.get("headers", [])), b"".join(chunks))
+        finally:
+            self.cache.end_preload(key, inflight, response)
+
+
+# Initialize the preload cache instance
+preload_cache: PreloadCache = PreloadCache()
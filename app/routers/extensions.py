@@ -1,23 +1,31 @@
 import asyncio
 import datetime
 import html
+import math
+import random
 import time
-from typing import List, NoReturn, Optional
+from typing import Awaitable, Callable, Dict, Hashable, Iterable, List, NoReturn, Optional, Set, Tuple
+from urllib.parse import urlencode
 
-from fastapi import APIRouter, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi import APIRouter, Query, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse
-from sse_starlette import EventSourceResponse
+from sse_starlette import EventSourceResponse, ServerSentEvent
+from sse_starlette.sse import SendTimeoutError
+from starlette.types import Send
 import logging
 
+from app.chatlog import CHAT_HISTORY_PAGE_MAX, CHAT_HISTORY_PAGE_SIZE, ChatLog, chat_log
+from app.disconnect import abandoned_requests
+from app.lag import lag_monitor
+from app.limits import route_limits
+from app.preload import preload_cache
+
 router = APIRouter(prefix="/extensions", tags=["EXT"])
 
 # Set up logging
+# Records go through the application-wide queue logging set up in app.log,
+# so they are formatted and written off the event loop thread
 logger = logging.getLogger(__name__)  # Create a logger object for this module
-logger.setLevel(logging.INFO)  # Set the logging level to INFO
-handler = logging.StreamHandler()  # Create a stream handler to output logs to the console
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')  # Define the log message format
-handler.setFormatter(formatter)  # Set the formatter for the handler
-logger.addHandler(handler)  # Add the handler to the logger
 
 # --------------------------------------------------------------------------------
 # SSE Event Triggered Route
@@ -37,66 +45,143 @@ async def sse_event_triggered(
 # Streaming Events Route (Server-Sent Events)
 # --------------------------------------------------------------------------------
 @router.get("/stream")
-async def message_stream(request: Request) -> EventSourceResponse:
+async def message_stream(request: Request) -> Response:
     """
     Streams events to the client using Server-Sent Events (SSE).
     Generates new messages every second.
+    Comment-line keepalives are sent every SSE_KEEPALIVE_INTERVAL seconds, and a
+    send that stalls for SSE_SEND_TIMEOUT seconds ends the stream (see ReapedEventSourceResponse).
+    While the server drains, new streams are refused with a Retry-After hint and
+    open streams end with a randomized `retry:` so clients reconnect spread out.
     """
+    if drainer.draining:
+        return Response(status_code=503, headers={"Retry-After": str(math.ceil(drainer.retry_after()))})
+
     async def event_generator():
-        count = 0
-        while True:
-            # If the client disconnects, stop the event stream
-            if await request.is_disconnected():
-                break
+        draining: asyncio.Event = drainer.open_stream()
+        try:
+            count = 0
+            while True:
+                # If the client disconnects, stop the event stream
+                if await request.is_disconnected():
+                    break
 
-            count += 1
-            # Send a message every second (e.g., every 1 count)
-            if count % 1 == 0:
-                yield {
-                    "event": "sse_event",
-                    "data": f"<div>SSE Content right here boys {count}</div>",
-                }
+                # If the server is draining, ask the client to reconnect at a random time
+                if drainer.draining:
+                    yield {"retry": int(drainer.retry_after() * 1000), "comment": "draining"}
+                    break
 
-            # Every 10 counts, send a special message
-            if count % 10 == 0:
-                yield {
-                    "event": "sse_event_10",
-                    "data": f"<div>SSE 10 Content right here boys {int(count/10)}</div>",
-                }
+                count += 1
+                # Send a message every second (e.g., every 1 count)
+                if count % 1 == 0:
+                    yield {
+                        "event": "sse_event",
+                        "data": f"<div>SSE Content right here boys {count}</div>",
+                    }
 
-            # Sleep for 1 second before sending the next message
-            await asyncio.sleep(1)
+                # Every 10 counts, send a special message
+                if count % 10 == 0:
+                    yield {
+                        "event": "sse_event_10",
+                        "data": f"<div>SSE 10 Content right here boys {int(count/10)}</div>",
+                    }
 
-    return EventSourceResponse(event_generator(), media_type="text/event-stream")
+                # Sleep for 1 second before sending the next message
+                await asyncio.sleep(1)
+        finally:
+            drainer.close_stream(draining)
+
+    return ReapedEventSourceResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        ping=SSE_KEEPALIVE_INTERVAL,
+        ping_message_factory=lambda: ServerSentEvent(comment="keepalive"),
+        send_timeout=SSE_SEND_TIMEOUT,
+    )
 
 
 # --------------------------------------------------------------------------------
 # WebSocket Route
 # --------------------------------------------------------------------------------
 @router.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket) -> NoReturn:
+async def websocket_endpoint(websocket: WebSocket, room: Optional[str] = None) -> NoReturn:
     """
     Handles WebSocket connections. Receives JSON messages from the client
-    and sends them to all connected clients.
+    and sends them to all connected clients. Connections that stay silent
+    (no chat or heartbeat messages) are pinged and eventually reaped.
+
+    A client can join a room with the `room` query parameter or by sending
+    `{"join": "<room>"}` (and leave it with `{"leave": "<room>"}`). Chat messages
+    go to the room named in the message, then to the room from the URL, and
+    otherwise to every connected client.
+
+    While the server drains, new connections are closed right away with 1013
+    (Try Again Later) and a retry hint.
     """
-    await manager.connect(websocket)
+    if drainer.draining:
+        await websocket.accept()
+        await websocket.close(code=1013, reason=f"Retry after {math.ceil(drainer.retry_after())}s")
+        return
+
+    await manager.connect(websocket, room)
+    reaper.track(
+        websocket,
+        "websocket",
+        close=lambda: websocket.close(code=1000, reason="Idle timeout"),
+        ping=lambda: websocket.send_text(WS_HEARTBEAT_FRAME),
+    )
     try:
         while True:
             # Wait for the client to send a message (JSON format)
             msg = await websocket.receive_json()
-            # Send the message to all connected clients
-            await manager.send_message(msg["chat_message"])
+            # Any message, including the client's heartbeat, counts as activity
+            reaper.touch(websocket)
+            if msg.get("join"):
+                manager.join(websocket, msg["join"])
+            if msg.get("leave"):
+                manager.leave(websocket, msg["leave"])
+            if "chat_message" in msg:
+                # Send the message to the connected clients of the target room
+                await manager.send_message(msg["chat_message"], msg.get("room") or room)
     except WebSocketDisconnect:
         # Handle client disconnection
         logger.info("Client has disconnected.")
     except Exception as e:
         # Handle any unexpected errors
-        logger.error(f"Error Occurred: {e}")
+        logger.error("Error Occurred: %s", e)
     finally:
         # Ensure the client is disconnected properly
+        reaper.untrack(websocket)
         await manager.disconnect(websocket)
 
 
+# --------------------------------------------------------------------------------
+# Chat History Route (GET)
+# --------------------------------------------------------------------------------
+@router.get("/chat/history", response_class=HTMLResponse)
+async def chat_history(
+    before: Optional[int] = Query(None, ge=0),
+    room: Optional[str] = None,
+    limit: int = Query(CHAT_HISTORY_PAGE_SIZE, ge=1, le=CHAT_HISTORY_PAGE_MAX),
+) -> HTMLResponse:
+    """
+    Returns the chat messages sent before sequence number `before`, oldest first,
+    preceded by a button that loads the page before them. The button swaps itself
+    for that page, so each click adds older messages above the ones shown.
+    Runs on the event loop, like the writes to the log: reads are memory-mapped
+    and only decode the messages of the page.
+    """
+    records, cursor = chat_log.before(before, limit, room)
+    lines: List[str] = [ConnectionManager.render_line(formatted_time, message) for _, formatted_time, message in records]
+    if cursor is not None:
+        query: str = urlencode({"before": cursor, "room": room} if room else {"before": cursor})
+        lines.insert(
+            0,
+            f'<button hx-get="/extensions/chat/history?{html.escape(query)}" hx-swap="outerHTML">Load older messages</button>',
+        )
+    return HTMLResponse(content="\n".join(lines))
+
+
 # --------------------------------------------------------------------------------
 # Loading States Route (POST)
 # --------------------------------------------------------------------------------
@@ -132,11 +217,18 @@ async def get_path_deps() -> HTMLResponse:
     """
     Returns a simple HTML list item.
     This is an example of a path dependency in a route.
+    It is the client-side fallback; connected pages get the item pushed over SSE.
     """
-    html_content: str = """
+    return HTMLResponse(content=render_path_deps_item())
+
+
+def render_path_deps_item() -> str:
+    """
+    Renders the list item that depends on /extensions/path_deps.
+    """
+    return """
         <li>Path Deps</li>
     """
-    return HTMLResponse(content=html_content)
 
 
 # --------------------------------------------------------------------------------
@@ -147,13 +239,123 @@ async def post_path_deps() -> HTMLResponse:
     """
     Returns an HTML button that can be used to post more data to the list.
     The button will not trigger a page reload and uses hx-swap for dynamic content update.
+    The fragments depending on this path are re-rendered once and pushed to the
+    pages subscribed to /extensions/path_deps/stream.
     """
+    await path_dependencies.invalidate("/extensions/path_deps")
     html_content: str = """
         <button hx-post="/path_deps" hx-swap="none">Post more to the list</button>
     """
     return HTMLResponse(content=html_content)
 
 
+# --------------------------------------------------------------------------------
+# Path Dependencies Stream Route (Server-Sent Events)
+# --------------------------------------------------------------------------------
+@router.get("/path_deps/stream")
+async def path_deps_stream(request: Request) -> Response:
+    """
+    Streams the re-rendered fragments of invalidated paths as `path_deps` events,
+    each one OOB swap payload covering every affected fragment.
+    The stream waits for the next update or the start of a drain, whichever comes
+    first, so a graceful restart does not wait for an update that may never come.
+    """
+    if drainer.draining:
+        return Response(status_code=503, headers={"Retry-After": str(math.ceil(drainer.retry_after()))})
+
+    async def event_generator():
+        updates: asyncio.Queue = path_dependencies.subscribe()
+        draining: asyncio.Event = drainer.open_stream()
+        try:
+            while not await request.is_disconnected():
+                if drainer.draining:
+                    yield {"retry": int(drainer.retry_after() * 1000), "comment": "draining"}
+                    break
+                # Keepalives are written by the response itself (ping=SSE_KEEPALIVE_INTERVAL)
+                update: asyncio.Task = asyncio.ensure_future(updates.get())
+                drain: asyncio.Task = asyncio.ensure_future(draining.wait())
+                try:
+                    await asyncio.wait({update, drain}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    # A cancelled get leaves its update in the queue
+                    update.cancel()
+                    drain.cancel()
+                if update.done() and not update.cancelled():
+                    yield {"event": "path_deps", "data": update.result()}
+        finally:
+            drainer.close_stream(draining)
+            path_dependencies.unsubscribe(updates)
+
+    return ReapedEventSourceResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        ping=SSE_KEEPALIVE_INTERVAL,
+        ping_message_factory=lambda: ServerSentEvent(comment="keepalive"),
+        send_timeout=SSE_SEND_TIMEOUT,
+    )
+
+
+# --------------------------------------------------------------------------------
+# Connection Statistics Route (GET)
+# --------------------------------------------------------------------------------
+@router.get("/connections")
+async def connection_stats() -> dict:
+    """
+    Returns the number of open long-lived connections, the ones tracked by the
+    reaper, and how many were reaped.
+    """
+    return {
+        "websocket": len(manager.active_connections),
+        "sse": drainer.streams,
+        "tracked": reaper.tracked(),
+        "reaped": dict(reaper.reaped),
+    }
+
+
+# --------------------------------------------------------------------------------
+# Preload Cache Statistics Route (GET)
+# --------------------------------------------------------------------------------
+@router.get("/preload_cache")
+async def preload_cache_stats() -> dict:
+    """
+    Returns the preload cache counters and the hit rate of the real requests.
+    """
+    return {**preload_cache.stats, "hit_rate": preload_cache.hit_rate()}
+
+
+# --------------------------------------------------------------------------------
+# Event Loop Lag Route (GET)
+# --------------------------------------------------------------------------------
+@router.get("/loop_lag")
+async def loop_lag() -> dict:
+    """
+    Returns the event-loop scheduling delay percentiles and the recent stall reports.
+    """
+    return lag_monitor.snapshot()
+
+
+# --------------------------------------------------------------------------------
+# Concurrency Limits Route (GET)
+# --------------------------------------------------------------------------------
+@router.get("/concurrency")
+async def concurrency_stats() -> dict:
+    """
+    Returns the concurrency limit, the queue depth and the shed counts of each limited route.
+    """
+    return route_limits.snapshot()
+
+
+# --------------------------------------------------------------------------------
+# Abandoned Requests Route (GET)
+# --------------------------------------------------------------------------------
+@router.get("/abandoned")
+async def abandoned_stats() -> dict:
+    """
+    Returns how many requests were abandoned by their client, and how many of those were cancelled.
+    """
+    return abandoned_requests.snapshot()
+
+
 # --------------------------------------------------------------------------------
 # Sweet Alert Confirmation Route (GET)
 # --------------------------------------------------------------------------------
@@ -171,44 +373,582 @@ async def sweet_alert_confirmed() -> HTMLResponse:
 # --------------------------------------------------------------------------------
 # SSE Connection Manager (Handles WebSocket connections)
 # --------------------------------------------------------------------------------
+
+# Chat broadcast coalescing. With a window of 0 every message is broadcast as soon
+# as it arrives; with a positive window (e.g. 0.005 - 0.05 seconds) the messages that
+# arrive inside one window are rendered into a single frame and broadcast once.
+CHAT_COALESCE_WINDOW: float = 0.0
+# Maximum number of messages in one coalesced frame. A full batch is flushed
+# immediately, without waiting for the window to close.
+CHAT_MAX_BATCH_SIZE: int = 50
+
+
 class ConnectionManager:
-    def __init__(self):
+    def __init__(
+        self,
+        coalesce_window: float = CHAT_COALESCE_WINDOW,
+        max_batch_size: int = CHAT_MAX_BATCH_SIZE,
+        log: Optional[ChatLog] = None,
+    ):
         """
-        Initializes the connection manager with an empty list of active connections.
+        Initializes the connection manager with an empty registry of active connections.
+        Optionally coalesces the messages arriving within `coalesce_window` seconds
+        into one broadcast of at most `max_batch_size` messages, and appends every
+        message to a durable chat `log`.
+
+        Connections are kept in insertion-ordered dicts used as ordered sets, so adding
+        and removing a connection is O(1) and broadcasts keep the connection order.
         """
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Dict[WebSocket, None] = {}
+        self.rooms: Dict[str, Dict[WebSocket, None]] = {}
+        self._memberships: Dict[WebSocket, Set[str]] = {}
+        self.coalesce_window: float = coalesce_window
+        self.max_batch_size: int = max(1, max_batch_size)
+        # Pending chat lines and flush timers, keyed by room (None means everyone)
+        self._pending: Dict[Optional[str], List[str]] = {}
+        self._flush_tasks: Dict[Optional[str], asyncio.Task] = {}
+        self.log: Optional[ChatLog] = log
 
-    async def connect(self, websocket: WebSocket) -> NoReturn:
+    async def connect(self, websocket: WebSocket, room: Optional[str] = None) -> NoReturn:
         """
-        Accepts a WebSocket connection and adds it to the list of active connections.
+        Accepts a WebSocket connection and adds it to the active connections,
+        optionally subscribing it to a room.
         """
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections[websocket] = None
+        if room:
+            self.join(websocket, room)
 
     async def disconnect(self, websocket: WebSocket) -> NoReturn:
         """
-        Removes the WebSocket connection from the list of active connections.
+        Removes the WebSocket connection from the active connections and from its rooms.
+        """
+        self.active_connections.pop(websocket, None)
+        for room in self._memberships.pop(websocket, ()):
+            self._discard(websocket, room)
+
+    def join(self, websocket: WebSocket, room: str) -> None:
+        """
+        Subscribes a connection to a room.
         """
-        self.active_connections.remove(websocket)
+        self.rooms.setdefault(room, {})[websocket] = None
+        self._memberships.setdefault(websocket, set()).add(room)
 
-    async def send_message(self, message: str) -> NoReturn:
+    def leave(self, websocket: WebSocket, room: str) -> None:
         """
-        Sends a message to all active WebSocket connections. Formats the message with a timestamp.
+        Unsubscribes a connection from a room.
         """
-        if not self.active_connections:
+        memberships = self._memberships.get(websocket)
+        if memberships is None or room not in memberships:
             return
+        memberships.discard(room)
+        if not memberships:
+            del self._memberships[websocket]
+        self._discard(websocket, room)
 
+    def _discard(self, websocket: WebSocket, room: str) -> None:
+        """
+        Removes a connection from a room's subscribers and drops the room once empty.
+        """
+        subscribers = self.rooms.get(room)
+        if subscribers is None:
+            return
+        subscribers.pop(websocket, None)
+        if not subscribers:
+            del self.rooms[room]
+
+    def _targets(self, room: Optional[str]) -> Dict[WebSocket, None]:
+        """
+        Returns the connections a broadcast to `room` reaches (everyone for None).
+        """
+        if room is None:
+            return self.active_connections
+        return self.rooms.get(room, {})
+
+    async def send_message(self, message: str, room: Optional[str] = None) -> NoReturn:
+        """
+        Sends a message to all active WebSocket connections, or only to the subscribers
+        of `room`. Formats the message with a timestamp.
+        When coalescing is enabled the message is queued and broadcast with the rest of its window.
+        The message is logged even if nobody is connected, so it shows up in the history.
+        A message the log fails to store (full or missing disk) is still broadcast.
+        """
         # Format the current time once for all connections
         formatted_time: str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        escaped_message: str = html.escape(message)
-        content: str = f"""
+        if self.log is not None:
+            try:
+                self.log.append(formatted_time, message, room)
+            except OSError as e:
+                logger.error("Chat log append failed: %s", e)
+        if not self._targets(room):
+            return
+
+        line: str = self.render_line(formatted_time, message)
+
+        if self.coalesce_window <= 0:
+            await self._broadcast(self._render([line]), self._targets(room))
+            return
+
+        pending = self._pending.setdefault(room, [])
+        pending.append(line)
+        if len(pending) >= self.max_batch_size:
+            await self._flush_room(room)
+        elif room not in self._flush_tasks:
+            self._flush_tasks[room] = asyncio.create_task(self._flush_later(room))
+
+    async def flush(self) -> NoReturn:
+        """
+        Broadcasts the queued messages of every room, if any, one frame per room.
+        """
+        for room in list(self._pending):
+            await self._flush_room(room)
+
+    async def _flush_room(self, room: Optional[str]) -> NoReturn:
+        """
+        Broadcasts the queued messages of one room as a single frame.
+        """
+        task = self._flush_tasks.pop(room, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        lines = self._pending.pop(room, None)
+        if not lines:
+            return
+        await self._broadcast(self._render(lines), self._targets(room))
+
+    async def _flush_later(self, room: Optional[str]) -> NoReturn:
+        """
+        Waits for the coalescing window to close and flushes the room's queued messages.
+        """
+        await asyncio.sleep(self.coalesce_window)
+        await self._flush_room(room)
+
+    @staticmethod
+    def render_line(formatted_time: str, message: str) -> str:
+        """
+        Renders one chat line, escaping the message.
+        """
+        return f"<p>{formatted_time} || {html.escape(message)}</p>"
+
+    @staticmethod
+    def _render(lines: List[str]) -> str:
+        """
+        Renders chat lines into one payload with a single OOB wrapper for #content.
+        """
+        joined: str = "\n            ".join(lines)
+        return f"""
             <div hx-swap-oob="beforeend:#content">
-            <p>{formatted_time} || {escaped_message}</p>
+            {joined}
             </div>
             <input hx-swap-oob="outerHTML:#web_socket_input" id="web_socket_input" name="chat_message" placeholder="Web Socket Phrase"/>
         """
-        for connection in self.active_connections:
-            await connection.send_text(content)
 
-# Initialize the connection manager instance
-manager: ConnectionManager = ConnectionManager()
+    @staticmethod
+    async def _broadcast(content: str, connections: Iterable[WebSocket]) -> NoReturn:
+        """
+        Sends an already rendered payload to the given connections. A failed send is
+        logged and skipped, so one dead connection does not cost the others the frame;
+        its own endpoint removes it when its receive loop ends.
+        """
+        # Iterate over a snapshot: connections may disconnect while we await a send
+        for connection in tuple(connections):
+            try:
+                await connection.send_text(content)
+            except Exception as e:
+                logger.warning("Broadcast to a connection failed: %s", e)
+
+# Initialize the connection manager instance, logging the chat to disk
+manager: ConnectionManager = ConnectionManager(log=chat_log)
+
+
+# --------------------------------------------------------------------------------
+# Idle Connection Reaper (Heartbeats for WebSocket connections)
+# --------------------------------------------------------------------------------
+
+# WebSocket connections without activity for this many seconds are closed. SSE streams
+# are not tracked: the server writes to them on its own (keepalives), so a dead peer
+# shows up as a stalled send, which SSE_SEND_TIMEOUT ends.
+IDLE_TIMEOUT: float = 60.0
+# How often the reaper sweeps the tracked connections.
+REAP_INTERVAL: float = 5.0
+# WebSocket connections idle for this many seconds are sent a heartbeat frame.
+# The page answers with its own `{"heartbeat": ...}` message on the same interval.
+WS_HEARTBEAT_INTERVAL: float = 20.0
+# An HTML comment: htmx has nothing to swap, so the heartbeat is invisible to the page.
+WS_HEARTBEAT_FRAME: str = "<!-- heartbeat -->"
+# Seconds between SSE comment-line keepalives.
+SSE_KEEPALIVE_INTERVAL: int = 15
+# An SSE write blocked for longer than this (dead peer, full buffers) ends the stream.
+SSE_SEND_TIMEOUT: float = 30.0
+
+
+class IdleReaper:
+    def __init__(
+        self,
+        idle_timeout: float = IDLE_TIMEOUT,
+        interval: float = REAP_INTERVAL,
+        heartbeat_interval: float = WS_HEARTBEAT_INTERVAL,
+    ):
+        """
+        Tracks the last activity of long-lived connections and closes the idle ones
+        from a single periodic sweep, instead of a timer per connection.
+
+        `_last_activity` is an insertion-ordered dict and every touch moves the
+        connection to its end, so it is always sorted from least to most recently
+        active and a sweep stops at the first connection that is still fresh.
+        """
+        self.idle_timeout: float = idle_timeout
+        self.interval: float = interval
+        self.heartbeat_interval: float = heartbeat_interval
+        self._last_activity: Dict[Hashable, float] = {}
+        self._pinged_at: Dict[Hashable, float] = {}
+        self._handlers: Dict[Hashable, Tuple[str, Callable[[], Awaitable], Optional[Callable[[], Awaitable]]]] = {}
+        self.reaped: Dict[str, int] = {"websocket": 0, "sse": 0}
+        self._task: Optional[asyncio.Task] = None
+        # Closes and pings in flight; held so they are not garbage collected
+        self._calls: Set[asyncio.Task] = set()
+
+    def track(
+        self,
+        key: Hashable,
+        kind: str,
+        close: Callable[[], Awaitable],
+        ping: Optional[Callable[[], Awaitable]] = None,
+    ) -> None:
+        """
+        Starts tracking a connection. `close` is awaited when it is reaped and
+        `ping`, if given, is awaited when it has been idle for a heartbeat interval.
+        """
+        self._handlers[key] = (kind, close, ping)
+        self._last_activity[key] = time.monotonic()
+
+    def touch(self, key: Hashable) -> None:
+        """
+        Records activity on a tracked connection.
+        """
+        if self._last_activity.pop(key, None) is not None:
+            self._last_activity[key] = time.monotonic()
+            self._pinged_at.pop(key, None)
+
+    def untrack(self, key: Hashable) -> None:
+        """
+        Stops tracking a connection.
+        """
+        self._last_activity.pop(key, None)
+        self._pinged_at.pop(key, None)
+        self._handlers.pop(key, None)
+
+    def tracked(self) -> Dict[str, int]:
+        """
+        Returns the number of tracked connections per kind.
+        """
+        counts: Dict[str, int] = {kind: 0 for kind in self.reaped}
+        for kind, _, _ in self._handlers.values():
+            counts[kind] = counts.get(kind, 0) + 1
+        return counts
+
+    async def sweep(self) -> int:
+        """
+        Closes the connections idle for longer than `idle_timeout` and pings the ones
+        idle for longer than `heartbeat_interval`. Returns the number of reaped connections.
+        The closes and pings run as tasks: a close waits for the peer's close handshake,
+        which a dead peer never sends, and must not hold up the rest of the sweep.
+        """
+        now: float = time.monotonic()
+        reap_before: float = now - self.idle_timeout
+        ping_before: float = now - self.heartbeat_interval
+        expired: List[Hashable] = []
+        idle: List[Hashable] = []
+        for key, last_activity in self._last_activity.items():
+            if last_activity > ping_before:
+                break
+            if last_activity <= reap_before:
+                expired.append(key)
+            elif now - self._pinged_at.get(key, last_activity) >= self.heartbeat_interval:
+                idle.append(key)
+
+        for key in expired:
+            kind, close, _ = self._handlers[key]
+            self.untrack(key)
+            self.reaped[kind] = self.reaped.get(kind, 0) + 1
+            self._call(close)
+
+        for key in idle:
+            handlers = self._handlers.get(key)
+            if handlers is None or handlers[2] is None:
+                continue
+            self._pinged_at[key] = now
+            self._call(handlers[2])
+
+        return len(expired)
+
+    def _call(self, call: Callable[[], Awaitable]) -> None:
+        """
+        Runs a close or ping callback in the background.
+        """
+        task: asyncio.Task = asyncio.create_task(self._quietly(call))
+        self._calls.add(task)
+        task.add_done_callback(self._calls.discard)
+
+    @staticmethod
+    async def _quietly(call: Callable[[], Awaitable]) -> None:
+        """
+        Awaits a close or ping callback, ignoring its failure.
+        """
+        try:
+            await call()
+        except Exception:
+            # The peer is usually already gone; the receive loop cleans it up
+            pass
+
+    async def _run(self) -> NoReturn:
+        """
+        Sweeps the tracked connections every `interval` seconds.
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.sweep()
+
+    def start(self) -> None:
+        """
+        Starts the background sweep on the running event loop.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the background sweep and the closes and pings still in flight.
+        """
+        calls: Tuple[asyncio.Task, ...] = tuple(self._calls)
+        for task in calls:
+            task.cancel()
+        await asyncio.gather(*calls, return_exceptions=True)
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+# Initialize the idle reaper instance
+reaper: IdleReaper = IdleReaper()
+
+
+class ReapedEventSourceResponse(EventSourceResponse):
+    """
+    SSE response that counts the streams ended by `send_timeout` as reaped SSE connections.
+    """
+
+    async def stream_response(self, send: Send) -> None:
+        try:
+            await super().stream_response(send)
+        except SendTimeoutError:
+            reaper.reaped["sse"] = reaper.reaped.get("sse", 0) + 1
+            raise
+
+
+# --------------------------------------------------------------------------------
+# Connection Drainer (Graceful shutdown of long-lived connections)
+# --------------------------------------------------------------------------------
+
+# Maximum number of seconds shutdown waits for the long-lived connections to drain.
+DRAIN_DEADLINE: float = 30.0
+# WebSocket connections closed per batch, and the pause between batches. The pause
+# shrinks when needed so the last batch is still closed within the deadline.
+DRAIN_BATCH_SIZE: int = 500
+DRAIN_BATCH_INTERVAL: float = 1.0
+# Range, in seconds, of the randomized reconnect delay suggested to the clients.
+DRAIN_RETRY_MIN: float = 1.0
+DRAIN_RETRY_MAX: float = 15.0
+# 1012 (Service Restart) is one of the close codes the htmx ws extension reconnects on,
+# with its own jittered backoff. 1001 (Going Away) would leave the page disconnected.
+WS_DRAIN_CLOSE_CODE: int = 1012
+
+
+class ConnectionDrainer:
+    def __init__(
+        self,
+        connections: ConnectionManager,
+        deadline: float = DRAIN_DEADLINE,
+        batch_size: int = DRAIN_BATCH_SIZE,
+        batch_interval: float = DRAIN_BATCH_INTERVAL,
+        retry_min: float = DRAIN_RETRY_MIN,
+        retry_max: float = DRAIN_RETRY_MAX,
+    ):
+        """
+        Drains the long-lived connections on shutdown, spreading the clients'
+        reconnects over time instead of cutting every connection at once.
+        """
+        self.connections: ConnectionManager = connections
+        self.deadline: float = deadline
+        self.batch_size: int = max(1, batch_size)
+        self.batch_interval: float = batch_interval
+        self.retry_min: float = retry_min
+        self.retry_max: float = retry_max
+        self.draining: bool = False
+        # One event per open SSE stream, set when the drain starts
+        self._streams: Set[asyncio.Event] = set()
+
+    @property
+    def streams(self) -> int:
+        """
+        The number of open SSE streams.
+        """
+        return len(self._streams)
+
+    def open_stream(self) -> asyncio.Event:
+        """
+        Registers an open SSE stream. Returns an event set once the drain starts,
+        for streams that would otherwise only see the drain on their next wake-up.
+        """
+        draining: asyncio.Event = asyncio.Event()
+        if self.draining:
+            draining.set()
+        self._streams.add(draining)
+        return draining
+
+    def close_stream(self, draining: asyncio.Event) -> None:
+        """
+        Unregisters an SSE stream that has ended.
+        """
+        self._streams.discard(draining)
+
+    def retry_after(self) -> float:
+        """
+        Returns a random reconnect delay in seconds.
+        """
+        return random.uniform(self.retry_min, self.retry_max)
+
+    async def drain(self) -> None:
+        """
+        Starts draining and waits, at most `deadline` seconds, until the WebSocket
+        connections are closed and the SSE streams have ended.
+        """
+        self.draining = True
+        for draining in self._streams:
+            draining.set()
+        try:
+            await asyncio.wait_for(self._drain(), self.deadline)
+        except asyncio.TimeoutError:
+            logger.warning("Drain deadline reached with connections still open.")
+
+    async def _drain(self) -> None:
+        """
+        Closes the WebSocket connections in paced batches, then waits for the SSE streams,
+        which end themselves with a randomized `retry:` once they see the drain.
+        The closes of a batch run concurrently and the next batch does not wait for them:
+        each close waits for the client's close handshake, which a dead client never sends.
+        """
+        websockets: Tuple[WebSocket, ...] = tuple(self.connections.active_connections)
+        batches: int = math.ceil(len(websockets) / self.batch_size)
+        interval: float = min(self.batch_interval, self.deadline / (batches + 1))
+        closing: List[asyncio.Task] = []
+        try:
+            for start in range(0, len(websockets), self.batch_size):
+                if start:
+                    await asyncio.sleep(interval)
+                closing.extend(
+                    asyncio.create_task(self._close(websocket))
+                    for websocket in websockets[start:start + self.batch_size]
+                )
+            await asyncio.gather(*closing)
+        finally:
+            # Past the deadline, the closes still waiting on their handshake are cut
+            for task in closing:
+                task.cancel()
+        while self.streams > 0:
+            await asyncio.sleep(0.1)
+
+    @staticmethod
+    async def _close(websocket: WebSocket) -> None:
+        """
+        Closes one WebSocket connection with the restart close code.
+        """
+        try:
+            await websocket.close(code=WS_DRAIN_CLOSE_CODE, reason="Server restarting")
+        except Exception:
+            # Already closed by the client
+            pass
+
+# Initialize the connection drainer instance
+drainer: ConnectionDrainer = ConnectionDrainer(manager)
+
+
+# --------------------------------------------------------------------------------
+# Path Dependencies Registry (Server-pushed fragment updates)
+# --------------------------------------------------------------------------------
+
+# Updates queued per subscriber. A subscriber that falls this far behind misses
+# updates rather than holding an unbounded backlog.
+PATH_DEPS_QUEUE_SIZE: int = 100
+
+
+class PathDependencies:
+    def __init__(self, queue_size: int = PATH_DEPS_QUEUE_SIZE):
+        """
+        Maps paths to the fragments rendered from them, and pushes the re-rendered
+        fragments to the subscribed pages when a path is written to.
+        """
+        self.queue_size: int = queue_size
+        # path -> target element id -> (swap style, render function)
+        self._fragments: Dict[str, Dict[str, Tuple[str, Callable[[], str]]]] = {}
+        self._subscribers: Dict[asyncio.Queue, None] = {}
+        self.dropped: int = 0
+
+    def register(self, path: str, target: str, render: Callable[[], str], swap: str = "innerHTML") -> None:
+        """
+        Declares that the element with id `target` is rendered by `render` from `path`,
+        and is updated with the `swap` style when the path changes.
+        """
+        self._fragments.setdefault(path, {})[target] = (swap, render)
+
+    def subscribe(self) -> asyncio.Queue:
+        """
+        Returns a queue receiving the update payloads.
+        """
+        updates: asyncio.Queue = asyncio.Queue(self.queue_size)
+        self._subscribers[updates] = None
+        return updates
+
+    def unsubscribe(self, updates: asyncio.Queue) -> None:
+        """
+        Stops sending updates to a queue.
+        """
+        self._subscribers.pop(updates, None)
+
+    def render(self, path: str) -> Optional[str]:
+        """
+        Renders every fragment depending on `path` into a single OOB swap payload.
+        """
+        fragments = self._fragments.get(path)
+        if not fragments:
+            return None
+        return "".join(
+            f'<div hx-swap-oob="{swap}:#{target}">{render()}</div>'
+            for target, (swap, render) in fragments.items()
+        )
+
+    async def invalidate(self, path: str) -> int:
+        """
+        Re-renders the fragments depending on `path` once and queues the payload for
+        every subscriber. Returns the number of subscribers it was queued for.
+        """
+        if not self._subscribers:
+            return 0
+        payload: Optional[str] = self.render(path)
+        if payload is None:
+            return 0
+        queued: int = 0
+        for updates in self._subscribers:
+            try:
+                updates.put_nowait(payload)
+                queued += 1
+            except asyncio.QueueFull:
+                self.dropped += 1
+        return queued
+
+# Initialize the path dependencies registry
+path_dependencies: PathDependencies = PathDependencies()
+path_dependencies.register("/extensions/path_deps", "path_deps_list", render_path_deps_item, swap="beforeend")
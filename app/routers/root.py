@@ -1,5 +1,9 @@
+from typing import Optional
+
 from app import templates  # Importing templates from your application's context
-from fastapi import APIRouter, Request, Response
+from app.chatlog import chat_log
+from app.people import PEOPLE_PAGE_MAX, PEOPLE_PAGE_SIZE, SEARCH_LIMIT, SEARCH_LIMIT_MAX, people, search_index
+from fastapi import APIRouter, Query, Request, Response
 from fastapi.responses import HTMLResponse
 
 router = APIRouter()
@@ -8,10 +12,11 @@ router = APIRouter()
 # Redirects to the index page
 # --------------------------------------------------------------------------------
 @router.get("/", summary="Redirects to the index page")
-def read_root(request: Request) -> Response:
+async def read_root(request: Request) -> Response:
     """
     This route handles requests to the root URL. It sets up some example conditions
-    and passes them along with a list of people to the 'index.html' template.
+    and passes them along with the first page of the list of people to the 'index.html'
+    template. The following pages are loaded by the page itself from '/people'.
     
     Args:
         request (Request): The FastAPI request object.
@@ -26,12 +31,8 @@ def read_root(request: Request) -> Response:
         False,
     )  # Replace these with your actual conditions as needed
 
-    # Example list of people
-    people = [
-        {"name": "Tom", "age": 10},
-        {"name": "Charles", "age": 5},
-        {"name": "Pam", "age": 7},
-    ]
+    # First page of the example list of people
+    first_page, next_cursor = people.page()
 
     # Render the 'index.html' template with context
     return templates.TemplateResponse(
@@ -41,7 +42,92 @@ def read_root(request: Request) -> Response:
             "bool_condition1": bool_condition1,
             "bool_condition2": bool_condition2,
             "bool_condition3": bool_condition3,
-            "some_list": people,
+            "some_list": first_page,
+            "next_cursor": next_cursor,
+            # Older chat messages are loaded from here, newer ones arrive over the WebSocket.
+            # The chat log is only used from the event loop, hence the async route.
+            "chat_before": chat_log.next_seq,
+        },
+    )
+
+
+# --------------------------------------------------------------------------------
+# Returns one page of the list of people
+# --------------------------------------------------------------------------------
+@router.get("/people", summary="Returns one page of the list of people", response_class=HTMLResponse)
+def people_page(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(PEOPLE_PAGE_SIZE, ge=1, le=PEOPLE_PAGE_MAX),
+) -> Response:
+    """
+    Returns the rows following `cursor` and, when more rows follow, a sentinel row
+    that loads the next page once it is revealed (infinite scroll).
+
+    Args:
+        request (Request): The FastAPI request object.
+        cursor (Optional[str]): The cursor returned with the previous page.
+        limit (int): The number of rows in the page.
+
+    Returns:
+        Response: The rendered rows, or a 400 response for an invalid cursor.
+    """
+    try:
+        rows, next_cursor = people.page(cursor, limit)
+    except ValueError:
+        return HTMLResponse(status_code=400)
+
+    return templates.TemplateResponse(
+        "people_rows.html",
+        {
+            "request": request,
+            "some_list": rows,
+            "next_cursor": next_cursor,
+            "limit": limit,
+        },
+    )
+
+
+# --------------------------------------------------------------------------------
+# Searches the list of people
+# --------------------------------------------------------------------------------
+@router.get("/people/search", summary="Searches the list of people", response_class=HTMLResponse)
+async def people_search(
+    request: Request,
+    q: str = "",
+    min_age: str = Query("", pattern=r"^\d*$"),
+    max_age: str = Query("", pattern=r"^\d*$"),
+    limit: int = Query(SEARCH_LIMIT, ge=1, le=SEARCH_LIMIT_MAX),
+) -> Response:
+    """
+    Active search over the people list: returns the rows of up to `limit` people whose
+    name contains `q` (names starting with it first) and whose age is within the range.
+    Queries shorter than three characters only match the start of the names. The
+    lookups go through the search index, so the time does not grow with the list.
+    The route is async so that every search runs on the event loop: the index and
+    its result cache are not safe to share between threadpool workers.
+
+    Args:
+        request (Request): The FastAPI request object.
+        q (str): The text to search for in the names.
+        min_age (str): The youngest age included; empty when the field is left blank.
+        max_age (str): The oldest age included; empty when the field is left blank.
+        limit (int): The maximum number of rows returned.
+
+    Returns:
+        Response: The rendered rows.
+    """
+    return templates.TemplateResponse(
+        "people_rows.html",
+        {
+            "request": request,
+            "some_list": search_index.search(
+                q,
+                int(min_age) if min_age else None,
+                int(max_age) if max_age else None,
+                limit,
+            ),
+            "next_cursor": None,
         },
     )
 
@@ -1,17 +1,221 @@
 import asyncio
+import logging
+import os
+import random
+import tempfile
 import time
 import datetime
-from app.routers.extensions import ConnectionManager
+from app import templates
+from app.chatlog import ChatLog
+from app.log import LOG_FORMAT, QueueLogging, StructuredFormatter
+from app.people import PeopleSearchIndex, PeopleStore
+from app.routers.extensions import ConnectionManager, logger
 
 class MockWebSocket:
+    async def accept(self):
+        pass
+
     async def send_text(self, text: str):
         pass
 
+class RecordingWebSocket(MockWebSocket):
+    """Records when each chat line is delivered, to measure the added latency."""
+    def __init__(self, sent_at: list):
+        self.sent_at = sent_at
+        self.frames = 0
+        self.delays = []
+
+    async def send_text(self, text: str):
+        now = time.perf_counter()
+        self.frames += 1
+        for _ in range(text.count("<p>")):
+            self.delays.append(now - self.sent_at[len(self.delays)])
+
+async def bench_coalescing(window: float, messages: int = 500, connections: int = 1000, gap: float = 0.001):
+    """Sends `messages` chat messages `gap` seconds apart and reports frames, throughput and latency."""
+    sent_at = []
+    recorder = RecordingWebSocket(sent_at)
+    manager = ConnectionManager(coalesce_window=window, max_batch_size=50)
+    manager.active_connections[recorder] = None
+    for _ in range(connections - 1):
+        manager.active_connections[MockWebSocket()] = None
+
+    start_time = time.perf_counter()
+    for _ in range(messages):
+        sent_at.append(time.perf_counter())
+        await manager.send_message("Test message")
+        await asyncio.sleep(gap)
+    await manager.flush()
+    elapsed = time.perf_counter() - start_time
+
+    delays = sorted(recorder.delays)
+    print(
+        f"window={window * 1000:>5.1f}ms frames={recorder.frames:>4} "
+        f"throughput={messages / elapsed:>7.0f} msg/s "
+        f"latency avg={sum(delays) / len(delays) * 1000:.2f}ms "
+        f"p99={delays[int(len(delays) * 0.99)] * 1000:.2f}ms"
+    )
+
+async def bench_churn(connections: int, rooms: int = 100):
+    """Connects `connections` sockets spread over `rooms` rooms, then disconnects them all in random order."""
+    manager = ConnectionManager()
+    sockets = [MockWebSocket() for _ in range(connections)]
+
+    start_time = time.perf_counter()
+    for i, websocket in enumerate(sockets):
+        await manager.connect(websocket, f"room-{i % rooms}")
+    connect_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for _ in range(100):
+        await manager.send_message("Test message", "room-0")
+    room_time = time.perf_counter() - start_time
+
+    random.shuffle(sockets)
+    start_time = time.perf_counter()
+    for websocket in sockets:
+        await manager.disconnect(websocket)
+    disconnect_time = time.perf_counter() - start_time
+
+    print(
+        f"connections={connections:>6} connect={connect_time:.3f}s "
+        f"disconnect={disconnect_time:.3f}s 100 room broadcasts={room_time:.3f}s"
+    )
+
+async def bench_logging(mode: str, connections: int = 10000):
+    """Broadcasts to `connections` sockets, then disconnects them all, logging like the WebSocket route."""
+    devnull = open(os.devnull, "w")
+    handler = logging.StreamHandler(devnull)
+    handler.setFormatter(StructuredFormatter(LOG_FORMAT))
+    queue_logging = QueueLogging(handler)
+    app_logger = logging.getLogger("app")
+    app_logger.setLevel(logging.INFO)
+    if mode == "sync":
+        app_logger.addHandler(handler)
+    elif mode == "queue":
+        queue_logging.start()
+    else:
+        logger.disabled = True
+
+    manager = ConnectionManager()
+    sockets = [MockWebSocket() for _ in range(connections)]
+    for websocket in sockets:
+        await manager.connect(websocket)
+
+    start_time = time.perf_counter()
+    for i in range(100):
+        await manager.send_message("Test message")
+        logger.info("Broadcast %s sent to %s clients", i, len(manager.active_connections))
+    broadcast_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for websocket in sockets:
+        logger.info("Client has disconnected.")
+        logger.error("Error Occurred: %s", "connection reset")
+        await manager.disconnect(websocket)
+    disconnect_time = time.perf_counter() - start_time
+
+    if mode == "sync":
+        app_logger.removeHandler(handler)
+    elif mode == "queue":
+        queue_logging.stop()
+    logger.disabled = False
+    devnull.close()
+    print(
+        f"logging={mode:<8} 100 broadcasts={broadcast_time:.3f}s "
+        f"disconnect storm={connections / disconnect_time:>9.0f} disconnects/s"
+    )
+
+def bench_people_pages(size: int, repeat: int = 20):
+    """Renders the whole people list and single pages of it, reporting time and payload size."""
+    store = PeopleStore({"name": f"Person {i}", "age": i % 100} for i in range(size))
+    rows_template = templates.get_template("people_rows.html")
+
+    everyone, _ = store.page(limit=size)
+    start_time = time.perf_counter()
+    full = rows_template.render(some_list=everyone, next_cursor=None)
+    full_time = time.perf_counter() - start_time
+
+    # Cursor of the last page, to compare fetching page K with page 1
+    cursor = None
+    last_cursor = None
+    while True:
+        _, next_cursor = store.page(cursor)
+        if next_cursor is None:
+            break
+        last_cursor, cursor = cursor, next_cursor
+    timings = {}
+    for name, page_cursor in (("first", None), ("last", last_cursor)):
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            rows, next_cursor = store.page(page_cursor)
+            page = rows_template.render(some_list=rows, next_cursor=next_cursor)
+        timings[name] = (time.perf_counter() - start_time) / repeat
+
+    print(
+        f"people={size:>6} full list={full_time * 1000:>8.2f}ms {len(full) / 1024:>7.0f}KiB | "
+        f"page 1={timings['first'] * 1000:.2f}ms last page={timings['last'] * 1000:.2f}ms {len(page) / 1024:.1f}KiB"
+    )
+
+def bench_people_search(size: int, repeat: int = 20):
+    """Builds the search index over `size` people and times searches, which should not grow with the list."""
+    rng = random.Random(size)
+    first = ["Ann", "Bob", "Carla", "Dmitri", "Eve", "Frank", "Grace", "Heidi", "Ivan", "Judy", "Oscar", "Peggy"]
+    last = ["Smith", "Jones", "Brown", "Taylor", "Wilson", "Davies", "Evans", "Thomas", "Johnson", "Roberts"]
+    store = PeopleStore(
+        {"name": f"{rng.choice(first)} {rng.choice(last)} {i}", "age": rng.randint(0, 99)} for i in range(size)
+    )
+
+    start_time = time.perf_counter()
+    index = PeopleSearchIndex(store)
+    build_time = time.perf_counter() - start_time
+
+    timings = {}
+    for name, args in (("prefix", ("gra",)), ("substring", ("son 1",)), ("no match", ("zzz",)), ("ages", ("", 30, 31)), ("both", ("smith", 30, 31))):
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            index._search(args[0], *(args[1:] or (None, None)), 20)
+        timings[name] = (time.perf_counter() - start_time) / repeat
+
+    start_time = time.perf_counter()
+    store.add("Grace Newcomer", 42)
+    update_time = time.perf_counter() - start_time
+
+    print(
+        f"people={size:>6} build={build_time:.2f}s add={update_time * 1000:.2f}ms | "
+        + " ".join(f"{name}={timing * 1000:.3f}ms" for name, timing in timings.items())
+    )
+    return timings
+
+def bench_chat_log(messages: int, repeat: int = 20):
+    """Appends `messages` chat messages to a fresh log, then pages back from the newest and from deep in the history."""
+    with tempfile.TemporaryDirectory() as directory:
+        log = ChatLog(directory)
+        start_time = time.perf_counter()
+        for i in range(messages):
+            log.append("2024-01-01 00:00:00", f"Chat message number {i}")
+        append_time = time.perf_counter() - start_time
+
+        timings = {}
+        for name, before in (("newest", None), ("middle", messages // 2), ("oldest", 100)):
+            log.before(before)  # The first read of an old segment builds its index
+            start_time = time.perf_counter()
+            for _ in range(repeat):
+                log.before(before)
+            timings[name] = (time.perf_counter() - start_time) / repeat
+
+        segments = log.stats["rolled"] + 1
+        log.close()
+    print(
+        f"messages={messages:>8} append={messages / append_time:>7.0f} msg/s segments={segments:>3} | page of 50: "
+        + " ".join(f"{name}={timing * 1000:.3f}ms" for name, timing in timings.items())
+    )
+
 async def main():
     manager = ConnectionManager()
     # Add many connections
     for _ in range(10000):
-        manager.active_connections.append(MockWebSocket())
+        manager.active_connections[MockWebSocket()] = None
 
     start_time = time.perf_counter()
     for _ in range(100):
@@ -20,5 +224,31 @@ async def main():
 
     print(f"Time taken for 100 broadcasts to 10,000 connections: {end_time - start_time:.6f} seconds")
 
+    print("Chat coalescing (500 messages 1ms apart, 1,000 connections):")
+    for window in (0.0, 0.005, 0.01, 0.025, 0.05):
+        await bench_coalescing(window)
+
+    print("Connection churn (connect, broadcast to 1 of 100 rooms, mass disconnect):")
+    for connections in (10000, 50000, 100000):
+        await bench_churn(connections)
+
+    print("Logging on the event loop (10,000 connections, records written to /dev/null):")
+    for mode in ("disabled", "sync", "queue"):
+        await bench_logging(mode)
+
+    print("People list rendering (whole list vs one 50-row page):")
+    for size in (1000, 10000, 100000):
+        bench_people_pages(size)
+
+    print("People search (uncached lookups, 20 results):")
+    searches = {size: bench_people_search(size) for size in (1000, 10000, 100000, 300000)}
+    # A query combined with an age filter must not grow with the list either
+    ratio = searches[300000]["both"] / searches[1000]["both"]
+    print(f"query and ages, 300,000 vs 1,000 people: {ratio:.1f}x ({'ok' if ratio <= 10 else 'grows with the list'})")
+
+    print("Chat log (append, then page back 50 messages):")
+    for messages in (10000, 100000, 1000000):
+        bench_chat_log(messages)
+
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,307 @@
+"""
+Connection-scale soak test for the long-lived endpoints.
+
+Starts the application on a local uvicorn worker, ramps up real WebSocket clients on
+/extensions/ws and SSE clients on /extensions/stream, holds them while one client
+broadcasts chat messages at a fixed rate, and samples the worker over time:
+RSS, bytes per connection, open file descriptors, broadcast latency percentiles and
+event-loop lag (the round trip of a trivial request while the worker is under load).
+
+The report is written as JSON. Worker statistics are read from /proc, so the harness
+needs Linux. Example:
+
+    python soak.py --ws 20000 --sse 5000 --ramp-rate 2000 --hold 120 --rate 2 --output soak.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import resource
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+from websockets.asyncio.client import connect
+
+SOAK_MESSAGE = re.compile(r"soak-(\d+)")
+
+
+# --------------------------------------------------------------------------------
+# Worker process statistics
+# --------------------------------------------------------------------------------
+def read_rss(pid: int) -> int:
+    """
+    Returns the resident set size of a process in bytes.
+    """
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def count_fds(pid: int) -> int:
+    """
+    Returns the number of open file descriptors of a process.
+    """
+    return len(os.listdir(f"/proc/{pid}/fd"))
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """
+    Returns the p50/p95/p99/max of a list of seconds, in milliseconds.
+    """
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    values = sorted(values)
+    pick = lambda q: round(values[min(len(values) - 1, int(len(values) * q))] * 1000, 3)
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(values[-1] * 1000, 3)}
+
+
+# --------------------------------------------------------------------------------
+# Soak clients
+# --------------------------------------------------------------------------------
+class Soak:
+    def __init__(self, args: argparse.Namespace):
+        """
+        Holds the client connections and the measurements of one soak run.
+        """
+        self.args = args
+        self.base_ws: str = f"ws://{args.host}:{args.port}/extensions/ws"
+        self.open: Dict[str, int] = {"websocket": 0, "sse": 0}
+        self.failed: Dict[str, int] = {"websocket": 0, "sse": 0}
+        self.sent_at: Dict[int, float] = {}
+        self.latencies: List[float] = []
+        self.stopping = asyncio.Event()
+
+    async def websocket_client(self, index: int) -> None:
+        """
+        Keeps one WebSocket client connected, draining broadcasts and sending heartbeats.
+        Every `sample_every`-th client measures the broadcast latency.
+        """
+        sampled = index % self.args.sample_every == 0
+        try:
+            async with connect(self.base_ws, open_timeout=60, ping_interval=None, max_queue=None) as websocket:
+                self.open["websocket"] += 1
+                try:
+                    heartbeat = asyncio.create_task(self.heartbeat(websocket))
+                    async for frame in websocket:
+                        if sampled:
+                            now = time.perf_counter()
+                            for seq in SOAK_MESSAGE.findall(frame):
+                                sent = self.sent_at.get(int(seq))
+                                if sent is not None:
+                                    self.latencies.append(now - sent)
+                    heartbeat.cancel()
+                finally:
+                    self.open["websocket"] -= 1
+        except Exception:
+            if not self.stopping.is_set():
+                self.failed["websocket"] += 1
+
+    async def heartbeat(self, websocket) -> None:
+        """
+        Sends the same heartbeat message as the page, so the idle reaper keeps the client.
+        """
+        while True:
+            await asyncio.sleep(20)
+            await websocket.send(json.dumps({"heartbeat": "pong"}))
+
+    async def sse_client(self) -> None:
+        """
+        Keeps one SSE client connected, draining the event stream.
+        """
+        try:
+            reader, writer = await asyncio.open_connection(self.args.host, self.args.port)
+        except OSError:
+            self.failed["sse"] += 1
+            return
+        self.open["sse"] += 1
+        try:
+            writer.write(
+                f"GET /extensions/stream HTTP/1.1\r\nHost: {self.args.host}\r\n"
+                "Accept: text/event-stream\r\n\r\n".encode()
+            )
+            await writer.drain()
+            while await reader.read(65536):
+                pass
+        except Exception:
+            if not self.stopping.is_set():
+                self.failed["sse"] += 1
+        finally:
+            self.open["sse"] -= 1
+            writer.close()
+
+    async def sender(self) -> None:
+        """
+        Broadcasts numbered chat messages at `rate` messages per second.
+        """
+        if self.args.rate <= 0:
+            return
+        async with connect(self.base_ws, open_timeout=60, ping_interval=None) as websocket:
+            reader = asyncio.create_task(self.drain(websocket))
+            seq = 0
+            while not self.stopping.is_set():
+                seq += 1
+                self.sent_at[seq] = time.perf_counter()
+                await websocket.send(json.dumps({"chat_message": f"soak-{seq}"}))
+                await asyncio.sleep(1 / self.args.rate)
+            reader.cancel()
+
+    @staticmethod
+    async def drain(websocket) -> None:
+        """
+        Reads and discards the frames a client receives.
+        """
+        async for _ in websocket:
+            pass
+
+    async def probe(self) -> Optional[float]:
+        """
+        Returns the round trip of a trivial request, which grows with the worker's event-loop lag.
+        """
+        start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection(self.args.host, self.args.port)
+            writer.write(f"GET /builtin/info HTTP/1.1\r\nHost: {self.args.host}\r\nConnection: close\r\n\r\n".encode())
+            await writer.drain()
+            await reader.readline()
+            writer.close()
+        except OSError:
+            return None
+        return time.perf_counter() - start
+
+    async def ramp(self, tasks: List[asyncio.Task]) -> None:
+        """
+        Opens the WebSocket and SSE clients at `ramp_rate` connections per second.
+        """
+        # Interleave both kinds by their relative position so they ramp up together
+        kinds = [kind for _, kind in sorted(
+            [((i + 1) / self.args.ws, "websocket") for i in range(self.args.ws)]
+            + [((i + 1) / self.args.sse, "sse") for i in range(self.args.sse)]
+        )]
+        step = max(1, self.args.ramp_rate // 10)
+        for start in range(0, len(kinds), step):
+            for index, kind in enumerate(kinds[start:start + step], start):
+                client = self.websocket_client(index) if kind == "websocket" else self.sse_client()
+                tasks.append(asyncio.create_task(client))
+            await asyncio.sleep(step / self.args.ramp_rate)
+
+    async def run(self, pid: int) -> dict:
+        """
+        Ramps up, holds the connections and returns the report.
+        """
+        baseline_rss = read_rss(pid)
+        samples = []
+        tasks: List[asyncio.Task] = []
+        sender = asyncio.create_task(self.sender())
+        ramp = asyncio.create_task(self.ramp(tasks))
+        start = time.perf_counter()
+        hold_until: Optional[float] = None
+
+        while hold_until is None or time.perf_counter() < hold_until:
+            await asyncio.sleep(self.args.sample_interval)
+            if hold_until is None and ramp.done():
+                hold_until = time.perf_counter() + self.args.hold
+            latencies, self.latencies = self.latencies, []
+            connections = self.open["websocket"] + self.open["sse"]
+            rss = read_rss(pid)
+            lag = await self.probe()
+            samples.append({
+                "t": round(time.perf_counter() - start, 3),
+                "phase": "ramp" if hold_until is None else "hold",
+                "connections": dict(self.open),
+                "failed": dict(self.failed),
+                "rss_bytes": rss,
+                "bytes_per_connection": (rss - baseline_rss) // connections if connections else None,
+                "fds": count_fds(pid),
+                "broadcast_latency_ms": percentiles(latencies),
+                "loop_lag_ms": round(lag * 1000, 3) if lag is not None else None,
+            })
+            print(json.dumps(samples[-1]), file=sys.stderr)
+
+        self.stopping.set()
+        await sender
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        peak = max(samples, key=lambda sample: sample["rss_bytes"])
+        return {
+            "config": vars(self.args),
+            "baseline_rss_bytes": baseline_rss,
+            "peak": {
+                "connections": peak["connections"],
+                "rss_bytes": peak["rss_bytes"],
+                "bytes_per_connection": peak["bytes_per_connection"],
+                "fds": peak["fds"],
+            },
+            "samples": samples,
+        }
+
+
+# --------------------------------------------------------------------------------
+# Worker process
+# --------------------------------------------------------------------------------
+def start_worker(host: str, port: int) -> subprocess.Popen:
+    """
+    Starts one uvicorn worker serving the application and waits until it accepts connections.
+    """
+    worker = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", host, "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return worker
+        except OSError:
+            time.sleep(0.2)
+    worker.kill()
+    raise RuntimeError("The uvicorn worker did not start")
+
+
+def raise_fd_limit() -> None:
+    """
+    Raises the open-file limit to its hard maximum, for this process and the worker it starts.
+    """
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ws", type=int, default=10000, help="WebSocket clients")
+    parser.add_argument("--sse", type=int, default=1000, help="SSE clients")
+    parser.add_argument("--ramp-rate", type=int, default=1000, help="new connections per second")
+    parser.add_argument("--hold", type=float, default=60, help="seconds to hold all connections")
+    parser.add_argument("--rate", type=float, default=1, help="chat messages broadcast per second")
+    parser.add_argument("--sample-interval", type=float, default=2, help="seconds between samples")
+    parser.add_argument("--sample-every", type=int, default=100, help="measure latency on every Nth WebSocket client")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    worker = start_worker(args.host, args.port)
+    try:
+        report = asyncio.run(Soak(args).run(worker.pid))
+    finally:
+        worker.terminate()
+        worker.wait()
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
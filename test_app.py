@@ -1,3 +1,5 @@
+import asyncio
+import time
 import pytest
 from app.main import app
 from fastapi.testclient import TestClient
@@ -16,6 +18,17 @@ def client():
         yield client
 
 
+@pytest.fixture(autouse=True)
+def chat_log_dir(tmp_path, monkeypatch):
+    """Fixture that keeps the chat log of every test in a temporary directory."""
+    from app.chatlog import chat_log
+
+    chat_log.close()
+    monkeypatch.setattr(chat_log, "directory", str(tmp_path / "chat"))
+    yield chat_log
+    chat_log.close()
+
+
 # --------------------------------------------------------------------------------
 # Test API Responses and Template Rendering
 # --------------------------------------------------------------------------------
@@ -27,6 +40,127 @@ def test_read_root(client):
     assert b"This is my HTML template." in response.content  # Check if the template content is correct
 
 
+def test_read_root_people_first_page(client):
+    """Test that the root page renders the first page of people inline, in name order."""
+    response = client.get("/")
+    assert response.status_code == 200
+    content = response.text
+    assert content.index("Charles is 5") < content.index("Pam is 7") < content.index("Tom is 10")
+    assert 'hx-trigger="revealed"' not in content  # The example list fits in one page
+
+
+def test_people_store_pages_by_cursor():
+    """Test that keyset pages cover the sorted list exactly once, even when rows change between pages."""
+    from app.people import PeopleStore
+
+    store = PeopleStore({"name": f"Person {i:03}", "age": i} for i in range(120))
+    rows, cursor = store.page(limit=50)
+    seen = [row["name"] for row in rows]
+
+    store.remove(rows[0]["id"])  # Changes before the cursor do not shift the next page
+    while cursor:
+        rows, cursor = store.page(cursor, limit=50)
+        seen.extend(row["name"] for row in rows)
+
+    assert seen == [f"Person {i:03}" for i in range(120)]
+    with pytest.raises(ValueError):
+        store.page("not-a-cursor")
+
+
+def test_people_page(client):
+    """Test the people page endpoint returns rows plus a revealed sentinel for the next page."""
+    response = client.get("/people?limit=2")
+    assert response.status_code == 200
+    assert "Charles is 5" in response.text
+    assert "Pam is 7" in response.text
+    assert 'hx-trigger="revealed"' in response.text
+
+    next_url = response.text.split('hx-get="')[1].split('"')[0].replace("&amp;", "&")
+    response = client.get(next_url)
+    assert "Tom is 10" in response.text
+    assert 'hx-trigger="revealed"' not in response.text
+
+    assert client.get("/people?cursor=broken").status_code == 400
+    assert client.get("/people?limit=0").status_code == 422
+
+
+def test_people_search_index():
+    """Test search order, age filters, limits, incremental updates and the result cache."""
+    from app.people import PeopleSearchIndex, PeopleStore
+
+    store = PeopleStore([
+        {"name": "Pam Smith", "age": 30},
+        {"name": "Paul Jones", "age": 40},
+        {"name": "Ann Pamela", "age": 25},
+        {"name": "Tom", "age": 10},
+    ])
+    index = PeopleSearchIndex(store)
+
+    names = lambda results: [person["name"] for person in results]
+    assert names(index.search("pam")) == ["Pam Smith", "Ann Pamela"]  # Prefix matches first
+    assert names(index.search("pa")) == ["Pam Smith", "Paul Jones"]  # Short queries match prefixes only
+    assert names(index.search("pam", min_age=26)) == ["Pam Smith"]
+    assert names(index.search("", min_age=20, max_age=35)) == ["Ann Pamela", "Pam Smith"]  # Age order
+    assert names(index.search("", limit=1)) == ["Tom"]
+
+    assert index.search("pam") is index.search("PAM ")
+    assert index.stats["hits"] == 2
+
+    added = store.add("Pamphile", 50)
+    assert names(index.search("pam")) == ["Pam Smith", "Pamphile", "Ann Pamela"]
+    store.remove(added["id"])
+    store.remove(1)
+    assert names(index.search("pam")) == ["Ann Pamela"]
+    assert names(index.search("", min_age=30)) == ["Paul Jones"]
+
+
+def test_people_search_plans_agree():
+    """Test that scanning the age range matches short queries the same way as the name indexes."""
+    from app.people import PeopleSearchIndex, PeopleStore
+
+    store = PeopleStore([{"name": "Pam", "age": 7}] + [{"name": f"Amy {n}", "age": 50} for n in range(5)])
+    index = PeopleSearchIndex(store)
+
+    names = lambda results: [person["name"] for person in results]
+    assert names(index.search("am", 0, 20)) == []  # The age range is the smaller set here
+    assert names(index.search("am", 0, 60)) == ["Amy 0", "Amy 1", "Amy 2", "Amy 3", "Amy 4"]
+    assert names(index.search("pam", 0, 20)) == ["Pam"]
+
+
+def test_people_search_age_plan_order():
+    """Test that the age-range plan returns prefix matches first, then list order, across ages."""
+    from app.people import PeopleSearchIndex, PeopleStore
+
+    # Many names match, few people are in the age range: the age range is scanned
+    store = PeopleStore([{"name": f"Smithson {n}", "age": 40 + n % 50} for n in range(500)] + [
+        {"name": "Zoe Smith", "age": 31},
+        {"name": "Smith Anna", "age": 31},
+        {"name": "Al Smithers", "age": 30},
+        {"name": "Smithy", "age": 30},
+        {"name": "Smith Young", "age": 5},
+    ])
+    index = PeopleSearchIndex(store)
+
+    names = lambda results: [person["name"] for person in results]
+    assert names(index.search("smith", 30, 31)) == ["Smith Anna", "Smithy", "Al Smithers", "Zoe Smith"]
+    assert names(index.search("smith", 30, 31, limit=3)) == ["Smith Anna", "Smithy", "Al Smithers"]
+    assert names(index.search("sm", 30, 31)) == ["Smith Anna", "Smithy"]
+
+
+def test_people_search_endpoint(client):
+    """Test the active search endpoint returns matching rows and accepts blank age fields."""
+    response = client.get("/people/search?q=to&min_age=&max_age=")
+    assert response.status_code == 200
+    assert "Tom is 10" in response.text
+    assert "Pam" not in response.text
+
+    response = client.get("/people/search?min_age=6&max_age=9")
+    assert "Pam is 7" in response.text
+    assert "Tom" not in response.text and "Charles" not in response.text
+
+    assert client.get("/people/search?min_age=-1").status_code == 422
+
+
 def test_delete_root(client):
     """Test the DELETE request on the root endpoint."""
     response = client.delete("/")
@@ -249,6 +383,849 @@ def test_websocket_endpoint(client):
         assert "test" in response  # Ensure the received message contains 'test'
 
 
+class RecordingWebSocket:
+    """Minimal WebSocket stand-in that records every frame sent to it."""
+    def __init__(self):
+        self.frames = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        self.frames.append(text)
+
+
+@pytest.mark.anyio
+async def test_connection_manager_coalesces_messages():
+    """Test that messages inside one coalescing window are broadcast as one frame."""
+    from app.routers.extensions import ConnectionManager
+
+    manager = ConnectionManager(coalesce_window=0.01, max_batch_size=10)
+    websocket = RecordingWebSocket()
+    await manager.connect(websocket)
+
+    await manager.send_message("first")
+    await manager.send_message("<second>")
+    assert websocket.frames == []  # Nothing is sent before the window closes
+
+    await asyncio.sleep(0.05)
+    assert len(websocket.frames) == 1
+    frame = websocket.frames[0]
+    assert frame.count('hx-swap-oob="beforeend:#content"') == 1
+    assert frame.count("<p>") == 2
+    assert frame.index("first") < frame.index("&lt;second&gt;")
+
+
+@pytest.mark.anyio
+async def test_connection_manager_skips_failed_sends():
+    """Test that a connection failing mid-broadcast does not cost the others the coalesced frame."""
+    from app.routers.extensions import ConnectionManager
+
+    class DeadWebSocket(RecordingWebSocket):
+        async def send_text(self, text):
+            raise RuntimeError("Cannot call send once a close message has been sent.")
+
+    manager = ConnectionManager(coalesce_window=0.01, max_batch_size=10)
+    websocket = RecordingWebSocket()
+    await manager.connect(DeadWebSocket())
+    await manager.connect(websocket)
+
+    await manager.send_message("first")
+    await asyncio.sleep(0.05)
+    assert len(websocket.frames) == 1
+
+    # The flush task survived: the next window is broadcast too
+    await manager.send_message("second")
+    await asyncio.sleep(0.05)
+    assert len(websocket.frames) == 2 and "second" in websocket.frames[1]
+
+
+@pytest.mark.anyio
+async def test_connection_manager_broadcasts_when_log_fails():
+    """Test that a chat log write error does not stop the live broadcast."""
+    from app.routers.extensions import ConnectionManager
+
+    class FullDiskLog:
+        def append(self, formatted_time, message, room=None):
+            raise OSError(28, "No space left on device")
+
+    manager = ConnectionManager(log=FullDiskLog())
+    websocket = RecordingWebSocket()
+    await manager.connect(websocket)
+
+    await manager.send_message("still live")
+    assert len(websocket.frames) == 1 and "still live" in websocket.frames[0]
+
+
+@pytest.mark.anyio
+async def test_connection_manager_flushes_full_batch():
+    """Test that a full batch is broadcast without waiting for the window."""
+    from app.routers.extensions import ConnectionManager
+
+    manager = ConnectionManager(coalesce_window=10, max_batch_size=3)
+    websocket = RecordingWebSocket()
+    await manager.connect(websocket)
+
+    for i in range(4):
+        await manager.send_message(f"message {i}")
+    assert len(websocket.frames) == 1
+    assert websocket.frames[0].count("<p>") == 3
+
+    await manager.flush()
+    assert len(websocket.frames) == 2
+    assert "message 3" in websocket.frames[1]
+
+
+@pytest.mark.anyio
+async def test_connection_manager_rooms():
+    """Test that room broadcasts only reach subscribers and that disconnect cleans up rooms."""
+    from app.routers.extensions import ConnectionManager
+
+    manager = ConnectionManager()
+    in_room, outside = RecordingWebSocket(), RecordingWebSocket()
+    await manager.connect(in_room, "games")
+    await manager.connect(outside)
+
+    await manager.send_message("room only", "games")
+    assert len(in_room.frames) == 1
+    assert outside.frames == []
+
+    await manager.send_message("everyone")
+    assert len(in_room.frames) == 2
+    assert len(outside.frames) == 1
+
+    manager.join(outside, "games")
+    await manager.disconnect(in_room)
+    assert list(manager.active_connections) == [outside]
+    assert list(manager.rooms["games"]) == [outside]
+
+    manager.leave(outside, "games")
+    assert "games" not in manager.rooms
+
+
+def test_websocket_room_join(client):
+    """Test joining a room through the URL and through a WebSocket message."""
+    with client.websocket_connect("/extensions/ws?room=lobby") as first:
+        with client.websocket_connect("/extensions/ws") as second:
+            second.send_json({"join": "lobby"})
+            second.send_json({"chat_message": "hello lobby", "room": "lobby"})
+            assert "hello lobby" in first.receive_text()
+            assert "hello lobby" in second.receive_text()
+
+
+def test_chat_log_pages_back_across_segments(tmp_path):
+    """Test that history pages walk back through rolled segments, per room, oldest first within a page."""
+    from app.chatlog import ChatLog
+
+    log = ChatLog(str(tmp_path), segment_bytes=1024, index_interval=4)
+    for i in range(200):
+        log.append("2024-01-01 00:00:00", f"message {i}", "lobby" if i % 10 == 0 else None)
+    assert log.stats["rolled"] > 2
+
+    seen = []
+    cursor = None
+    while True:
+        records, cursor = log.before(cursor, limit=25)
+        seen = [message for _, _, message in records] + seen
+        if cursor is None:
+            break
+    assert seen == [f"message {i}" for i in range(200) if i % 10]
+
+    records, cursor = log.before(limit=3, room="lobby")
+    assert [message for _, _, message in records] == ["message 170", "message 180", "message 190"]
+    assert cursor == 170
+    records, _ = log.before(cursor, limit=100, room="lobby", scan_limit=15)
+    assert [message for _, _, message in records] == ["message 160"]  # Scanning stops early
+    log.close()
+
+
+def test_chat_log_recovers_and_applies_retention(tmp_path):
+    """Test that a torn last write is dropped on reopen and that old segments are deleted."""
+    import os
+    from app.chatlog import ChatLog
+
+    log = ChatLog(str(tmp_path))
+    for i in range(10):
+        log.append("2024-01-01 00:00:00", f"message {i}")
+    log.close()
+    (segment,) = os.listdir(tmp_path)
+    with open(tmp_path / segment, "r+b") as file:
+        file.truncate(os.path.getsize(tmp_path / segment) - 3)
+
+    log = ChatLog(str(tmp_path))
+    assert log.next_seq == 9
+    assert log.stats["truncated_bytes"] > 0
+    assert log.append("2024-01-01 00:00:00", "after restart") == 9
+    assert log.before(limit=2)[0][-1][2] == "after restart"
+    log.close()
+
+    log = ChatLog(str(tmp_path), segment_bytes=256, retention_segments=3)
+    for i in range(100):
+        log.append("2024-01-01 00:00:00", f"message {i}")
+    assert len(os.listdir(tmp_path)) == 3
+    assert log.stats["deleted"] > 0
+    records, cursor = log.before(limit=1000)
+    assert cursor is None
+    assert records[-1][2] == "message 99" and records[0][0] > 0  # Only the retained history
+    log.close()
+
+
+def test_chat_log_opens_on_startup(chat_log_dir):
+    """Test that the chat log is opened during startup, off the event loop, not by the first request."""
+    opened_on = []
+    open_log = chat_log_dir._open
+
+    def recording_open():
+        if chat_log_dir._fd is None:
+            opened_on.append(asyncio._get_running_loop())  # None on a worker thread
+        open_log()
+
+    chat_log_dir._open = recording_open
+    try:
+        with TestClient(app) as started_client:
+            assert len(opened_on) == 1
+            assert started_client.get("/").status_code == 200
+    finally:
+        del chat_log_dir._open
+    assert opened_on == [None]
+
+
+def test_chat_history_endpoint(client):
+    """Test that chat messages are logged and paged back through the history endpoint."""
+    with client.websocket_connect("/extensions/ws") as websocket:
+        for i in range(3):
+            websocket.send_json({"chat_message": f"<old {i}>"})
+            websocket.receive_text()
+
+    assert "Load older messages" in client.get("/").text
+    response = client.get("/extensions/chat/history?limit=2")
+    assert response.status_code == 200
+    assert "&lt;old 1&gt;" in response.text and "&lt;old 2&gt;" in response.text
+    next_url = response.text.split('hx-get="')[1].split('"')[0].replace("&amp;", "&")
+    response = client.get(next_url)
+    assert "&lt;old 0&gt;" in response.text
+    assert "Load older messages" not in response.text
+
+
+@pytest.mark.anyio
+async def test_idle_reaper_pings_and_reaps():
+    """Test that the reaper pings idle connections and closes expired ones in one sweep."""
+    from app.routers.extensions import IdleReaper
+
+    reaper = IdleReaper(idle_timeout=0.1, interval=1, heartbeat_interval=0.02)
+    events = []
+
+    async def close(name):
+        events.append(("close", name))
+
+    async def ping(name):
+        events.append(("ping", name))
+
+    reaper.track("old", "websocket", lambda: close("old"), lambda: ping("old"))
+    await asyncio.sleep(0.05)
+    reaper.track("idle", "websocket", lambda: close("idle"), lambda: ping("idle"))
+    reaper.track("sse", "sse", lambda: close("sse"))
+    await asyncio.sleep(0.06)
+    reaper.touch("sse")
+
+    assert await reaper.sweep() == 1
+    await asyncio.sleep(0)  # Closes and pings run as tasks
+    assert events == [("close", "old"), ("ping", "idle")]
+    assert reaper.reaped == {"websocket": 1, "sse": 0}
+    assert reaper.tracked() == {"websocket": 1, "sse": 1}
+
+    # A connection that was already pinged is not pinged again within the interval
+    assert await reaper.sweep() == 0
+    await asyncio.sleep(0)
+    assert events.count(("ping", "idle")) == 1
+
+
+@pytest.mark.anyio
+async def test_sse_send_timeout_counts_as_reaped():
+    """Test that an SSE stream ended by a stalled send is counted as a reaped SSE connection."""
+    from sse_starlette.sse import SendTimeoutError
+    from app.routers.extensions import ReapedEventSourceResponse, reaper
+
+    closed = []
+
+    async def events():
+        try:
+            while True:
+                yield {"data": "tick"}
+        finally:
+            closed.append(True)
+
+    async def stalled_send(message):
+        if message["type"] == "http.response.body":
+            await asyncio.sleep(10)  # The peer stopped reading
+
+    before = reaper.reaped["sse"]
+    response = ReapedEventSourceResponse(events(), send_timeout=0.05)
+    with pytest.raises(SendTimeoutError):
+        await response.stream_response(stalled_send)
+    assert closed == [True]
+    assert reaper.reaped["sse"] == before + 1
+
+
+@pytest.mark.anyio
+async def test_idle_reaper_does_not_wait_for_dead_peers():
+    """Test that a close waiting on a dead peer's handshake does not hold up the sweep."""
+    from app.routers.extensions import IdleReaper
+
+    reaper = IdleReaper(idle_timeout=0.05, interval=1, heartbeat_interval=0.02)
+    pinged = []
+
+    async def hanging_close():
+        await asyncio.sleep(10)  # Like a close handshake the peer never answers
+
+    async def ping():
+        pinged.append(True)
+
+    reaper.track("dead-1", "websocket", hanging_close)
+    reaper.track("dead-2", "websocket", hanging_close)
+    await asyncio.sleep(0.06)
+    reaper.track("alive", "websocket", hanging_close, ping)
+    await asyncio.sleep(0.03)
+
+    start = time.perf_counter()
+    assert await reaper.sweep() == 2
+    await asyncio.sleep(0)
+    assert time.perf_counter() - start < 0.5
+    assert pinged == [True]
+    await reaper.stop()
+    assert not reaper._calls
+
+
+def test_connection_stats(client):
+    """Test that connection statistics count tracked WebSocket connections."""
+    with client.websocket_connect("/extensions/ws") as websocket:
+        websocket.send_json({"heartbeat": "pong"})
+        websocket.send_json({"chat_message": "stats"})
+        websocket.receive_text()
+        response = client.get("/extensions/connections")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["websocket"] == 1
+        assert data["tracked"]["websocket"] == 1
+        assert data["sse"] == 0
+        assert "sse" in data["reaped"]
+
+
+@pytest.fixture
+def draining():
+    """Fixture that puts the connection drainer in drain mode for one test."""
+    from app.routers.extensions import drainer
+
+    drainer.draining = True
+    yield drainer
+    drainer.draining = False
+
+
+def test_drain_refuses_new_connections(client, draining):
+    """Test that new SSE and WebSocket connections are refused with a retry hint while draining."""
+    from starlette.websockets import WebSocketDisconnect
+
+    response = client.get("/extensions/stream")
+    assert response.status_code == 503
+    assert 1 <= int(response.headers["Retry-After"]) <= 15
+
+    with client.websocket_connect("/extensions/ws") as websocket:
+        with pytest.raises(WebSocketDisconnect) as disconnect:
+            websocket.receive_text()
+    assert disconnect.value.code == 1013
+    assert disconnect.value.reason.startswith("Retry after")
+
+
+@pytest.mark.anyio
+async def test_drain_ends_sse_stream_with_retry():
+    """Test that an open SSE stream ends with a randomized retry once draining starts."""
+    from app.routers.extensions import drainer, message_stream
+
+    class MockRequest:
+        async def is_disconnected(self):
+            return False
+
+    response = await message_stream(MockRequest())
+    iterator = response.body_iterator
+    await anext(iterator)
+    assert drainer.streams == 1
+
+    drainer.draining = True
+    try:
+        item = await anext(iterator)
+        assert 1000 <= item["retry"] <= 15000
+        with pytest.raises(StopAsyncIteration):
+            await anext(iterator)
+    finally:
+        drainer.draining = False
+    assert drainer.streams == 0
+
+
+@pytest.mark.anyio
+async def test_drain_closes_websockets_in_batches():
+    """Test that WebSocket connections are closed in paced batches with a restart close code."""
+    from app.routers.extensions import ConnectionDrainer, ConnectionManager
+
+    closed = []
+
+    class ClosingWebSocket(RecordingWebSocket):
+        async def close(self, code, reason):
+            closed.append((time.monotonic(), code))
+            await asyncio.sleep(0.2)  # The client's close handshake takes a round trip
+
+    manager = ConnectionManager()
+    for _ in range(5):
+        await manager.connect(ClosingWebSocket())
+
+    drainer = ConnectionDrainer(manager, deadline=5, batch_size=2, batch_interval=0.05)
+    start = time.monotonic()
+    await drainer.drain()
+    assert drainer.draining
+    assert [code for _, code in closed] == [1012] * 5
+    # Three batches, so the last close comes at least two intervals after the first
+    assert closed[-1][0] - closed[0][0] >= 0.09
+    # The handshakes overlap instead of adding up (5 x 0.2 s one after another)
+    assert closed[-1][0] - closed[0][0] < 0.2
+    assert time.monotonic() - start < 0.6
+
+
+@pytest.mark.anyio
+async def test_drain_does_not_wait_for_dead_clients():
+    """Test that a client that never answers the close handshake does not hold up the other batches."""
+    from app.routers.extensions import ConnectionDrainer, ConnectionManager
+
+    closed = []
+
+    class DeadWebSocket(RecordingWebSocket):
+        async def close(self, code, reason):
+            await asyncio.sleep(10)
+
+    class ClosingWebSocket(RecordingWebSocket):
+        async def close(self, code, reason):
+            closed.append(code)
+
+    manager = ConnectionManager()
+    await manager.connect(DeadWebSocket())
+    for _ in range(3):
+        await manager.connect(ClosingWebSocket())
+
+    drainer = ConnectionDrainer(manager, deadline=0.5, batch_size=1, batch_interval=0.05)
+    start = time.monotonic()
+    await drainer.drain()
+    assert closed == [1012] * 3
+    assert time.monotonic() - start < 1  # Only the dead client runs into the deadline
+
+
+# --------------------------------------------------------------------------------
+# Test Logging
+# --------------------------------------------------------------------------------
+
+def test_queue_logging_formats_off_the_calling_thread():
+    """Test that records are formatted and written by the listener thread, not the caller."""
+    import logging
+    import threading
+    from app.log import QueueLogging
+
+    written = []
+
+    class RecordingHandler(logging.Handler):
+        def emit(self, record):
+            written.append((self.format(record), threading.current_thread()))
+
+    queue_logging = QueueLogging(RecordingHandler())
+    queue_logging.start()
+    try:
+        logging.getLogger("app.test").info("Value is %s", 42)
+    finally:
+        queue_logging.stop()
+
+    assert len(written) == 1
+    message, thread = written[0]
+    assert message == "Value is 42"
+    assert thread is not threading.current_thread()
+    assert logging.getLogger("app").propagate  # Previous configuration is restored
+
+
+def test_duplicate_filter_suppresses_repeats():
+    """Test that repeated messages are rate-limited and counted on the next one let through."""
+    import logging
+    from app.log import DuplicateFilter
+
+    duplicate_filter = DuplicateFilter(limit=2, window=0.05)
+
+    def record():
+        return logging.LogRecord("app.test", logging.ERROR, __file__, 1, "Error Occurred: %s", ("boom",), None)
+
+    assert [duplicate_filter.filter(record()) for _ in range(5)] == [True, True, False, False, False]
+
+    time.sleep(0.06)
+    next_record = record()
+    assert duplicate_filter.filter(next_record)
+    assert next_record.suppressed == 3
+
+
+def test_access_log_is_not_rate_limited_as_duplicates(monkeypatch):
+    """Test that every sampled request of the full app is logged, beyond the duplicate limit."""
+    import logging
+    from app.log import DUPLICATE_LIMIT, queue_logging
+
+    written = []
+
+    class RecordingHandler(logging.Handler):
+        def emit(self, record):
+            written.append(record)
+
+    monkeypatch.setattr(queue_logging, "handler", RecordingHandler())
+    with TestClient(app) as logged_client:
+        for _ in range(DUPLICATE_LIMIT + 5):
+            assert logged_client.get("/builtin/element").status_code == 200
+
+    access = [record for record in written if record.name == "app.access"]
+    assert len(access) == DUPLICATE_LIMIT + 5
+
+
+def test_queue_logging_silences_uvicorn_access_log():
+    """Test that uvicorn's own, unsampled access log stays off while the queue logging runs."""
+    import logging
+    from app.log import QueueLogging
+
+    queue_logging = QueueLogging(logging.NullHandler())
+    queue_logging.start()
+    try:
+        # uvicorn logs a request only if this is True, whatever access_log says
+        assert not logging.getLogger("uvicorn.access").hasHandlers()
+    finally:
+        queue_logging.stop()
+
+
+def test_access_log_sampling(caplog):
+    """Test that the access log records structured fields and honours per-route sample rates."""
+    import logging
+    from fastapi import FastAPI
+    from app.log import AccessLogMiddleware
+
+    sampled_app = FastAPI()
+    sampled_app.add_middleware(AccessLogMiddleware, sample_rates={"/never/{item}": 0.0})
+
+    @sampled_app.get("/always")
+    async def always():
+        return {}
+
+    @sampled_app.get("/never/{item}")
+    async def never(item: str):
+        return {}
+
+    with caplog.at_level(logging.INFO, logger="app.access"):
+        with TestClient(sampled_app) as sampled_client:
+            sampled_client.get("/always")
+            sampled_client.get("/never/1")
+
+    records = [record for record in caplog.records if record.name == "app.access"]
+    assert len(records) == 1
+    assert records[0].fields["path"] == "/always"
+    assert records[0].fields["status"] == 200
+    assert records[0].fields["sample_rate"] == 1.0
+
+
+# --------------------------------------------------------------------------------
+# Test Preload Cache
+# --------------------------------------------------------------------------------
+
+@pytest.fixture
+def preload_app():
+    """Fixture that creates an app with a counting route behind the preload cache."""
+    from fastapi import FastAPI
+    from fastapi.responses import HTMLResponse
+    from app.preload import PreloadCache, PreloadCacheMiddleware
+
+    cache = PreloadCache(ttl=5)
+    preload_app = FastAPI()
+    preload_app.add_middleware(PreloadCacheMiddleware, cache=cache, routes=frozenset(["/fragment", "/private"]))
+    preload_app.state.calls = 0
+
+    @preload_app.get("/fragment")
+    async def fragment():
+        preload_app.state.calls += 1
+        return HTMLResponse(f"<div>render {preload_app.state.calls}</div>")
+
+    @preload_app.get("/private")
+    async def private():
+        preload_app.state.calls += 1
+        return HTMLResponse("<div>private</div>", headers={"Cache-Control": "no-store"})
+
+    with TestClient(preload_app) as preload_client:
+        yield preload_app, preload_client, cache
+
+
+def test_preload_cache_serves_real_request(preload_app):
+    """Test that the real request after a preload is served from the cache, once."""
+    preload_app, preload_client, cache = preload_app
+
+    preloaded = preload_client.get("/fragment", headers={"HX-Preloaded": "true"})
+    assert preloaded.text == "<div>render 1</div>"
+
+    real = preload_client.get("/fragment")
+    assert real.text == "<div>render 1</div>"
+    assert real.headers["X-Preload-Cache"] == "hit"
+    assert preload_app.state.calls == 1
+
+    # The entry is used once; the next request renders again
+    assert preload_client.get("/fragment").text == "<div>render 2</div>"
+    assert cache.stats["hits"] == 1
+    assert cache.stats["misses"] == 1
+    assert cache.hit_rate() == 0.5
+
+
+def test_preload_cache_is_per_client_and_opt_out(preload_app):
+    """Test that entries are not shared between clients and that no-store responses are not kept."""
+    preload_app, preload_client, cache = preload_app
+
+    preload_client.get("/fragment", headers={"HX-Preloaded": "true", "User-Agent": "first"})
+    assert preload_client.get("/fragment", headers={"User-Agent": "second"}).text == "<div>render 2</div>"
+
+    # Two sessions behind one address and browser
+    preload_client.get("/fragment", headers={"HX-Preloaded": "true", "Cookie": "session=alice"})
+    assert preload_client.get("/fragment", headers={"Cookie": "session=bob"}).text == "<div>render 4</div>"
+    preload_client.get("/fragment", headers={"HX-Preloaded": "true", "Authorization": "Bearer alice"})
+    assert preload_client.get("/fragment", headers={"Authorization": "Bearer bob"}).text == "<div>render 6</div>"
+
+    preload_client.get("/private", headers={"HX-Preloaded": "true"})
+    preload_client.get("/private")
+    assert preload_app.state.calls == 8
+    assert cache.stats["stored"] == 3  # The /fragment preloads only
+
+
+def test_preload_cache_memory_bound():
+    """Test that the oldest entries are evicted once the cache is over its memory limit."""
+    from app.preload import PreloadCache
+
+    cache = PreloadCache(max_bytes=10)
+    cache.put(("a",), (200, [], b"123456"))
+    cache.put(("b",), (200, [], b"123456"))
+    assert cache.pop(("a",)) is None
+    assert cache.pop(("b",)) == (200, [], b"123456")
+    assert cache.stats["evictions"] == 1
+
+
+def test_preload_cache_stats(client):
+    """Test that the preload cache statistics are exposed."""
+    client.get("/extensions/loading_states", headers={"HX-Preloaded": "true"})
+    response = client.get("/extensions/loading_states")
+    assert response.headers["X-Preload-Cache"] == "hit"
+    data = client.get("/extensions/preload_cache").json()
+    assert data["preloads"] >= 1
+    assert data["hits"] >= 1
+    assert "hit_rate" in data
+
+
+def block_event_loop(seconds):
+    """Blocks the calling thread, standing in for a blocking call inside a handler."""
+    time.sleep(seconds)
+
+
+@pytest.mark.anyio
+async def test_lag_monitor_reports_blocking_call():
+    """Test that a stall is measured, reported once with the blocking stack, and rate-limited."""
+    from app.lag import LagMonitor
+
+    monitor = LagMonitor(interval=0.01, threshold=0.1, report_interval=60)
+    monitor.start()
+    try:
+        await asyncio.sleep(0.05)
+        block_event_loop(0.3)
+        await asyncio.sleep(0.05)
+        block_event_loop(0.3)
+        await asyncio.sleep(0.05)
+    finally:
+        await monitor.stop()
+
+    snapshot = monitor.snapshot()
+    assert snapshot["stalls"] == 2
+    assert snapshot["reported"] == 1 and snapshot["suppressed"] == 1
+    assert snapshot["lag_ms"]["max"] >= 250
+    report = snapshot["reports"][0]
+    assert report["lag_ms"] >= 250
+    assert "block_event_loop" in "".join(report["stack"])
+
+
+def test_loop_lag_endpoint(client):
+    """Test that the loop lag diagnostics are exposed."""
+    data = client.get("/extensions/loop_lag").json()
+    assert set(data["lag_ms"]) == {"p50", "p95", "p99", "max"}
+    assert {"stalls", "reported", "suppressed", "reports"} <= set(data)
+
+
+@pytest.mark.anyio
+async def test_concurrency_limit_queues_in_order_and_sheds():
+    """Test that a full limit queues requests in arrival order and sheds on a full queue or a timeout."""
+    from app.limits import ConcurrencyLimit
+
+    limit = ConcurrencyLimit(limit=1, queue=2, max_wait=0.1, retry_after=1)
+    admitted = []
+
+    async def request(name):
+        if await limit.acquire():
+            admitted.append(name)
+            await asyncio.sleep(0.02)
+            limit.release()
+            return True
+        return False
+
+    results = await asyncio.gather(request("a"), request("b"), request("c"), request("d"))
+    assert results == [True, True, True, False]  # "d" finds the queue full
+    assert admitted == ["a", "b", "c"]
+
+    assert await limit.acquire()
+    assert not await limit.acquire()  # Nobody releases the slot within max_wait
+    limit.release()
+    snapshot = limit.snapshot()
+    assert snapshot["active"] == 0 and snapshot["queue_depth"] == 0
+    assert snapshot["shed_full"] == 1 and snapshot["shed_timeout"] == 1
+
+
+@pytest.mark.anyio
+async def test_concurrency_limit_waiter_cancelled_during_release():
+    """Test that a queued request cancelled in the same loop turn as a release is cancelled cleanly."""
+    from app.limits import ConcurrencyLimit
+
+    limit = ConcurrencyLimit(limit=1, queue=2, max_wait=1, retry_after=1)
+    assert await limit.acquire()
+    waiting = asyncio.ensure_future(limit.acquire())
+    await asyncio.sleep(0)
+    waiting.cancel()
+    await asyncio.sleep(0)
+    limit.release()  # Drops the cancelled waiter before its task has cleaned up
+
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    snapshot = limit.snapshot()
+    assert snapshot["active"] == 0 and snapshot["queue_depth"] == 0
+    assert await limit.acquire()
+
+
+def test_concurrency_limit_middleware_sheds_with_retry_hint():
+    """Test that shed requests get a 503 with Retry-After, plus a retry event for htmx."""
+    from app.limits import ConcurrencyLimitMiddleware, RouteLimits
+
+    limits = RouteLimits({("GET", "/builtin/info"): {"limit": 0, "queue": 0, "max_wait": 0, "retry_after": 3}})
+    with TestClient(ConcurrencyLimitMiddleware(app, limits)) as limited_client:
+        response = limited_client.get("/builtin/info")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "3"
+        assert "HX-Trigger" not in response.headers
+
+        response = limited_client.get("/builtin/info", headers={"HX-Request": "true"})
+        assert response.headers["HX-Trigger"] == '{"server-busy": {"retryAfter": 3}}'
+
+        assert limited_client.get("/builtin/element").status_code == 200  # Other routes are not limited
+    assert limits.snapshot()["GET /builtin/info"]["shed_full"] == 2
+
+
+def test_concurrency_stats(client):
+    """Test that the concurrency limits of the slow routes are exposed."""
+    assert client.get("/builtin/sync_first").status_code == 200
+    data = client.get("/extensions/concurrency").json()
+    sync_first = data["GET /builtin/sync_first"]
+    assert sync_first["admitted"] >= 1
+    assert sync_first["active"] == 0 and sync_first["queue_depth"] == 0
+    assert "POST /extensions/loading_states" in data
+
+
+async def call_and_disconnect(asgi_app, method, path, after):
+    """Calls an ASGI app with a client that disconnects `after` seconds in; returns the messages sent."""
+    scope = {
+        "type": "http", "http_version": "1.1", "method": method, "path": path, "raw_path": path.encode(),
+        "root_path": "", "scheme": "http", "query_string": b"", "headers": [], "client": ("test", 1), "server": ("test", 80),
+    }
+    requested = False
+    sent = []
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await asyncio.sleep(after)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    await asyncio.wait_for(asyncio.ensure_future(asgi_app(scope, receive, send)), 5)
+    return sent
+
+
+@pytest.mark.anyio
+async def test_disconnect_cancels_abandoned_handler():
+    """Test that a slow handler is cancelled, without a response, once its client disconnects."""
+    from app.disconnect import AbandonedRequests, CancelOnDisconnectMiddleware
+
+    abandoned = AbandonedRequests()
+    start = time.perf_counter()
+    sent = await call_and_disconnect(CancelOnDisconnectMiddleware(app, abandoned=abandoned), "GET", "/builtin/sync_first", 0.05)
+    assert time.perf_counter() - start < 1  # The handler sleeps for 2 seconds
+    assert sent == []
+    assert abandoned.snapshot() == {"abandoned": 1, "cancelled": 1, "finished": 0, "routes": {"GET /builtin/sync_first": 1}}
+
+
+@pytest.mark.anyio
+async def test_disconnect_stops_thread_work_and_spares_exempt_routes():
+    """Test that offloaded thread work sees the cancel flag, and that exempt routes run to the end."""
+    import anyio
+    from app.disconnect import AbandonedRequests, CancelOnDisconnectMiddleware, cancelled
+
+    steps = []
+
+    def work():
+        for _ in range(100):
+            if cancelled():
+                return
+            steps.append(1)
+            time.sleep(0.01)
+
+    async def slow_app(scope, receive, send):
+        await anyio.to_thread.run_sync(work)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"done"})
+
+    abandoned = AbandonedRequests()
+    sent = await call_and_disconnect(CancelOnDisconnectMiddleware(slow_app, abandoned=abandoned), "GET", "/work", 0.05)
+    assert sent == [] and len(steps) < 20
+
+    steps.clear()
+    exempt = CancelOnDisconnectMiddleware(slow_app, exempt=frozenset([("GET", "/work")]), abandoned=abandoned)
+    sent = await call_and_disconnect(exempt, "GET", "/work", 0.05)
+    assert len(steps) == 100
+    assert sent[-1]["body"] == b"done"
+    assert abandoned.stats == {"abandoned": 2, "cancelled": 1, "finished": 1}
+
+
+@pytest.mark.anyio
+async def test_disconnect_leaves_closed_streams_alone():
+    """Test that a streaming response closed by its client ends itself and is not counted as abandoned."""
+    from starlette.responses import StreamingResponse
+    from app.disconnect import AbandonedRequests, CancelOnDisconnectMiddleware
+
+    async def events():
+        while True:
+            yield b"data: tick\n\n"
+            await asyncio.sleep(0.01)
+
+    abandoned = AbandonedRequests()
+    stream = StreamingResponse(events(), media_type="text/event-stream")
+    sent = await call_and_disconnect(CancelOnDisconnectMiddleware(stream, abandoned=abandoned), "GET", "/stream", 0.05)
+    assert sent[0]["type"] == "http.response.start"
+    assert any(message.get("body") == b"data: tick\n\n" for message in sent)
+    assert abandoned.stats == {"abandoned": 0, "cancelled": 0, "finished": 0}
+
+
+def test_abandoned_stats(client):
+    """Test that completed requests are not counted as abandoned."""
+    before = client.get("/extensions/abandoned").json()["abandoned"]
+    assert client.get("/builtin/element").status_code == 200
+    assert client.get("/extensions/abandoned").json()["abandoned"] == before
+
+
 # --------------------------------------------------------------------------------
 # Test Response and State Changes
 # --------------------------------------------------------------------------------
@@ -302,6 +1279,92 @@ def test_post_path_deps(client):
     assert b'<button hx-post="/path_deps" hx-swap="none">Post more to the list</button>' in response.content
 
 
+@pytest.mark.anyio
+async def test_path_dependencies_render_once_for_all_subscribers():
+    """Test that an invalidated path is rendered once and queued as one OOB payload per subscriber."""
+    from app.routers.extensions import PathDependencies
+
+    renders = []
+
+    def render():
+        renders.append(1)
+        return "<li>item</li>"
+
+    registry = PathDependencies()
+    registry.register("/items", "list", render, swap="beforeend")
+    registry.register("/items", "count", lambda: "1")
+    subscribers = [registry.subscribe() for _ in range(3)]
+
+    assert await registry.invalidate("/items") == 3
+    assert await registry.invalidate("/other") == 0
+    assert len(renders) == 1
+    payload = subscribers[0].get_nowait()
+    assert payload == (
+        '<div hx-swap-oob="beforeend:#list"><li>item</li></div>'
+        '<div hx-swap-oob="innerHTML:#count">1</div>'
+    )
+    assert all(updates.get_nowait() == payload for updates in subscribers[1:])
+
+
+@pytest.mark.anyio
+async def test_path_deps_stream_pushes_on_post():
+    """Test that a POST to the path pushes the re-rendered fragment to the SSE stream."""
+    from app.routers.extensions import path_deps_stream, post_path_deps
+
+    class MockRequest:
+        async def is_disconnected(self):
+            return False
+
+    response = await path_deps_stream(MockRequest())
+    iterator = response.body_iterator
+    pending = asyncio.ensure_future(anext(iterator))
+    await asyncio.sleep(0.01)  # Let the stream subscribe
+
+    await post_path_deps()
+    item = await asyncio.wait_for(pending, 1)
+    assert item["event"] == "path_deps"
+    assert 'hx-swap-oob="beforeend:#path_deps_list"' in item["data"]
+    assert "<li>Path Deps</li>" in item["data"]
+    await iterator.aclose()
+
+
+@pytest.mark.anyio
+async def test_path_deps_stream_ends_as_soon_as_draining_starts(monkeypatch):
+    """Test that a path_deps stream waiting for an update ends right away once the drain starts."""
+    from app.routers.extensions import drainer, path_deps_stream
+
+    class MockRequest:
+        async def is_disconnected(self):
+            return False
+
+    monkeypatch.setattr(drainer, "deadline", 5)
+    response = await path_deps_stream(MockRequest())
+    iterator = response.body_iterator
+    pending = asyncio.ensure_future(anext(iterator))
+    await asyncio.sleep(0.01)  # Let the stream wait for an update
+    assert drainer.streams == 1
+
+    start = time.monotonic()
+    try:
+        drain = asyncio.ensure_future(drainer.drain())
+        item = await asyncio.wait_for(pending, 1)
+        assert 1000 <= item["retry"] <= 15000
+        with pytest.raises(StopAsyncIteration):
+            await anext(iterator)
+        await asyncio.wait_for(drain, 1)
+    finally:
+        drainer.draining = False
+    assert time.monotonic() - start < 0.5
+    assert drainer.streams == 0
+
+
+def test_path_deps_fallback_filter(client):
+    """Test that the refetch fallback filter reads the event target: htmx 1.8.6 calls filters without `this`."""
+    content = client.get("/").text
+    assert "path-deps[!event.target.closest('[data-sse-open]')]" in content
+    assert "this.closest" not in content
+
+
 # --------------------------------------------------------------------------------
 # Test Miscellaneous Functionality
 # --------------------------------------------------------------------------------